@@ -6,11 +6,18 @@
 
 from __future__ import print_function
 
-import copy
-import csv
+import atexit
+import collections
 import logging
+import os
+import re
+import resource
+import signal
 import subprocess
+import sys
+import threading
 import time
+from contextlib import contextmanager
 from os import environ, path
 
 # seconds to wait between subsequent metric collection runs:
@@ -18,6 +25,115 @@ SLEEP_TIME = int(environ.get("SLEEP_TIME", 60))
 
 TEXTFILE_DIR = environ.get("TEXTFILE_DIR")
 
+# flush the textfile (and the directory entry) to disk on every write if set to 1:
+FSYNC = int(environ.get("FSYNC", 0))
+
+# interval in milliseconds for streaming mode using a persistent `nvidia-smi` process
+# started with `--loop-ms` (instead of one call per SLEEP_TIME), 0 disables streaming:
+LOOP_MS = int(environ.get("LOOP_MS", 0))
+
+# the collector backend, either "smi" (calling `nvidia-smi`) or "nvml" (using the NVML
+# library directly through `ctypes`, without any process spawning or text parsing):
+BACKEND = environ.get("BACKEND", "smi")
+
+NVML_LIBRARY = environ.get("NVML_LIBRARY", "libnvidia-ml.so.1")
+
+# port for serving the metrics via HTTP at `/metrics` (instead of writing a textfile),
+# 0 disables the built-in HTTP server:
+LISTEN_PORT = int(environ.get("LISTEN_PORT", 0))
+LISTEN_ADDRESS = environ.get("LISTEN_ADDRESS", "")
+
+# seconds for which the collected metrics are re-used to answer HTTP requests:
+CACHE_TTL = float(environ.get("CACHE_TTL", 5))
+
+# interval in milliseconds for sampling internally at a higher rate than SLEEP_TIME, the
+# samples are aggregated into `_min`, `_max`, `_avg` and `_last` series that are written
+# every SLEEP_TIME seconds, 0 disables the aggregation:
+SAMPLE_MS = int(environ.get("SAMPLE_MS", 0))
+
+# seconds after which the static properties (e.g. serial, PCI bus, power limit) are
+# re-queried, otherwise they are only queried at startup and when the set of GPUs
+# changes. 0 disables the split and queries all properties every time:
+STATIC_REFRESH = int(environ.get("STATIC_REFRESH", 3600))
+
+# align the collection runs to wall-clock multiples of SLEEP_TIME (e.g. to :00, :15, :30
+# and :45 seconds for SLEEP_TIME=15) if set to 1, plus a per-host offset of up to SPLAY
+# seconds (derived from the hostname) to avoid all hosts running at the same moment:
+ALIGN = int(environ.get("ALIGN", 0))
+SPLAY = float(environ.get("SPLAY", 0))
+
+# seconds after which a hanging `nvidia-smi` call (e.g. due to a wedged driver) is
+# killed:
+SMI_TIMEOUT = float(environ.get("SMI_TIMEOUT", 30))
+
+# after consecutive failed collections the following runs are skipped with an
+# exponential backoff (0, 1, 3, 7, ... runs, so a single failure is retried right away),
+# at most for BACKOFF_MAX seconds. After BREAKER_THRESHOLD consecutive failures only one
+# attempt every BACKOFF_MAX seconds is made:
+BACKOFF_MAX = int(environ.get("BACKOFF_MAX", 600))
+BREAKER_THRESHOLD = int(environ.get("BREAKER_THRESHOLD", 5))
+
+# report the GPU memory used by each process (through a separate query for the compute
+# applications) if set to 1, at most PROCESS_SERIES_MAX processes are reported (the
+# ones that have been reported before take precedence to limit the series churn):
+PROCESSES = int(environ.get("PROCESSES", 0))
+PROCESS_SERIES_MAX = int(environ.get("PROCESS_SERIES_MAX", 500))
+
+# add the Slurm job ID, the Kubernetes pod UID and the user owning each process as
+# labels (derived from `/proc/<pid>/cgroup` and `/proc/<pid>/status`) if set to 1:
+JOB_LABELS = int(environ.get("JOB_LABELS", 0))
+PROC_ROOT = environ.get("PROC_ROOT", "/proc")
+
+# export counters integrated from the sampled gauges (e.g. `nvsmi_energy_joules_total`
+# from the power draw) if set to 1. Their values are kept in STATE_FILE (by default in
+# TEXTFILE_DIR) so they survive restarts, an empty value disables the persistence:
+COUNTERS = int(environ.get("COUNTERS", 0))
+STATE_FILE = environ.get(
+    "STATE_FILE", path.join(TEXTFILE_DIR, ".nvsmi-state.json") if TEXTFILE_DIR else ""
+)
+
+# probe which properties are not supported by the GPUs at startup (and whenever the
+# driver version or the GPU models change) and leave them out of the queries if set to
+# 1. The results are cached in PROBE_CACHE (by default in TEXTFILE_DIR) per driver
+# version and GPU model, an empty value disables the cache:
+PROBE = int(environ.get("PROBE", 1))
+PROBE_CACHE = environ.get(
+    "PROBE_CACHE",
+    path.join(TEXTFILE_DIR, ".nvsmi-capabilities.json") if TEXTFILE_DIR else "",
+)
+
+# additional properties to query for, as a comma separated list of names or glob
+# patterns (e.g. "clocks.current.*,pstate") matched against the catalog of all
+# properties supported by `nvidia-smi --help-query-gpu`. The catalog is cached in
+# CATALOG_CACHE (by default in TEXTFILE_DIR), an empty value disables the cache:
+EXTRA_FIELDS = environ.get("EXTRA_FIELDS", "")
+CATALOG_CACHE = environ.get(
+    "CATALOG_CACHE",
+    path.join(TEXTFILE_DIR, ".nvsmi-catalog.json") if TEXTFILE_DIR else "",
+)
+
+# render and write the metrics in a separate thread (for the textfile modes), so a slow
+# write (e.g. to NFS) never delays the next sample. If the writer can't keep up, only
+# the latest snapshot is written and the intermediate ones are dropped (and counted):
+ASYNC_WRITE = int(environ.get("ASYNC_WRITE", 1))
+
+# metric groups to monitor through a persistent `nvidia-smi dmon` child (e.g. "puct" for
+# power and temperature, utilization, clocks and PCI-E throughput), sampled every second
+# and exported as `nvsmi_dmon_*` aggregates over the samples since the previous write.
+# An empty value disables it:
+DMON = environ.get("DMON", "")
+
+# metric groups to monitor per process through a persistent `nvidia-smi pmon` child
+# (e.g. "um" for SM / memory / encoder / decoder utilization and frame buffer memory),
+# exported as `nvsmi_pmon_*` aggregates per process. At most PROCESS_SERIES_MAX
+# processes are tracked, a process is evicted after not being seen for PMON_EVICT
+# write intervals. An empty value disables it:
+PMON = environ.get("PMON", "")
+PMON_EVICT = int(environ.get("PMON_EVICT", 3))
+
+# `time.monotonic` is not available on Python 2:
+monotonic = getattr(time, "monotonic", time.time)
+
 LOG = logging.getLogger()
 LOG.addHandler(logging.StreamHandler())
 LOG.setLevel(logging.WARNING)
@@ -62,15 +178,47 @@ class PromMetricCollection(object):
             self.metrics[metric.name] = PromMetricMulti(metric)
         LOG.debug("Added Prometheus metric to collection: [%s]", metric.name)
 
+    def add_line(self, name, help_line, type_line, nlv_string):
+        """Add a metric to the collection without requiring a `PromMetric` object.
+
+        Parameters
+        ----------
+        name : str
+            The metric's name.
+        help_line : str
+            The metric's complete '# HELP ...' line.
+        type_line : str
+            The metric's complete '# TYPE ...' line.
+        nlv_string : str
+            The name-labels-value (NLV) string.
+        """
+        multi = self.metrics.get(name)
+        if multi is None:
+            self.metrics[name] = PromMetricMulti(
+                PromMetric(name, help_line, type_line, nlv_string)
+            )
+        else:
+            multi.nlv_strings.append(nlv_string)
+
+    def chunks(self):
+        """Format the collection as a list of strings, one per metric name.
+
+        Returns
+        -------
+        list(str)
+            The '# HELP' and '# TYPE' lines and all NLV lines of each metric.
+        """
+        chunks = list()
+        for name in self.metrics:
+            output = [self.metrics[name].help, self.metrics[name].type]
+            output.extend(self.metrics[name].nlv_strings)
+            output.append("")
+            chunks.append("\n".join(output))
+        return chunks
+
     def __str__(self):
         """Format the collection to be processed by Prometheus."""
-        output = list()
-        for name in self.metrics:
-            output.append("%s\n" % self.metrics[name].help)
-            output.append("%s\n" % self.metrics[name].type)
-            for nlv_string in self.metrics[name].nlv_strings:
-                output.append("%s\n" % nlv_string)
-        return "".join(output)
+        return "".join(self.chunks())
 
 
 class PromMetricMulti(object):
@@ -214,9 +362,18 @@ class NvMetric(object):
     enabled : bool
         Flag to disable this metric. Changes the behavior of the `value` getter method
         and the `format_prometheus` method.
+    static : bool
+        Flag indicating the metric (almost) never changes for a given GPU, so it doesn't
+        need to be queried on every run.
+    unit : str or None
+        The unit `nvidia-smi` reports for this metric (e.g. `MiB`), derived from the
+        `value_type` attribute.
+    label_format : str
+        The format string for the (processed) value when the metric is used as a label,
+        e.g. `0x%02X` for a `hex` value with two digits.
     """
 
-    def __init__(self, metric_name, description, value_type):
+    def __init__(self, metric_name, description, value_type, static=False, digits=0):
         """Initialize the NvMetric instance.
 
         Parameters
@@ -227,19 +384,28 @@ class NvMetric(object):
             See the class attributes for details.
         value_type : str
             See the class attributes for details.
+        static : bool, optional
+            See the class attributes for details, by default False.
+        digits : int, optional
+            The number of digits to zero-pad `hex` values to when used as a label (the
+            way `nvidia-smi` reports them), by default 0.
         """
         self.name = metric_name
         self.name_suffix = ""
         self.description = description
         self._convert = None
         self.value_type = value_type
+        self.unit = None
+        self.label_format = "%s"
         if value_type == "pct":
             self.value_type = "int"
             self.name_suffix = "_ratio"
+            self.unit = "%"
             self._convert = self.convert_percent
         elif value_type == "mb":
             self.value_type = "int"
             self.name_suffix = "_bytes"
+            self.unit = "MiB"
             self._convert = self.convert_mb
         elif value_type == "degc":
             self.value_type = "int"
@@ -247,7 +413,23 @@ class NvMetric(object):
         elif value_type == "watt":
             self.value_type = "float"
             self.name_suffix = "_watts"
+            self.unit = "W"
+        elif value_type == "mhz":
+            self.value_type = "int"
+            self.name_suffix = "_hertz"
+            self.unit = "MHz"
+            self._convert = self.convert_mhz
+        elif value_type == "bitmask":
+            self._convert = self.convert_hex
+        elif value_type == "hex":
+            self.label_format = "0x%%0%dX" % digits if digits else "0x%X"
+            self._convert = self.convert_hex
+        if self._convert is None and self.value_type == "int":
+            self._convert = int
+        elif self._convert is None and self.value_type == "float":
+            self._convert = float
         self.enabled = True
+        self.static = static
         self._value = None
 
     @property
@@ -261,14 +443,9 @@ class NvMetric(object):
     def value(self, new_value):
         """Set the value associated with this metric after processing it.
 
-        The setter will first strip surrounding whitespace from the new value. Then it
-        checks for specific contents and takes special action, e.g. in case the new
-        value is "[Not Supported]" (literally) it will NOT set the value (leaving it to
-        `None`) and set the metric's `enabled` attribute to `False`. Eventually, it will
-        split the new value on spaces and only keep the first segment (to remove
-        possible unit strings that are usually returned by `nvidia-smi`) unless the
-        `value_type` attribute is set to `str` (in which case it will literally keep the
-        entire string value).
+        See `parse()` for details on the processing. In case the new value cannot be
+        parsed (e.g. it is "[Not Supported]" literally) the value is NOT set (leaving
+        it to `None`) and the metric's `enabled` attribute is set to `False`.
 
         Parameters
         ----------
@@ -276,24 +453,71 @@ class NvMetric(object):
             The value to be stored in this metric.
         """
         LOG.debug("%s -> <%s>", self, new_value)
-        self._value = new_value.strip()
-        if self.value == "[Not Supported]":
+        value = self.parse(new_value)
+        if value is None:
             self.disable()
             return
+        self._value = value
+
+    def parse(self, raw_value):
+        """Process a raw value from `nvidia-smi` without storing it.
+
+        This will first strip surrounding whitespace from the value. Then it checks
+        for specific contents, e.g. in case the value is "[Not Supported]" (literally)
+        it will return `None`. Eventually, it will split the value on spaces and only
+        keep the first segment (to remove possible unit strings that are usually
+        returned by `nvidia-smi`) unless the `value_type` attribute is set to `str` (in
+        which case it will literally keep the entire string value) and apply the
+        conversion method (if any).
+
+        Parameters
+        ----------
+        raw_value : str
+            The value as reported by `nvidia-smi`.
+
+        Returns
+        -------
+        object or None
+            The processed value or `None` in case it's not supported or conversion
+            failed.
+        """
+        value = raw_value.strip()
+        if value == "[Not Supported]":
+            return None
         if self.value_type == "str":
-            return
-        self._value = self._value.split(" ")[0]
+            return value
+        return self.parse_plain(value.split(" ")[0])
 
-        if self._convert:
-            try:
-                self._value = self._convert(self._value)
-            except ValueError:
-                # in case conversion fails with a `ValueError` disable the metric:
-                LOG.info("Converting value '%s' failed, disabling metric", self._value)
-                self.disable()
-            except Exception as err:  # pylint: disable-msg=broad-except
-                LOG.error("Error converting value '%s': %s", self.value, err)
-                self.disable()
+    def parse_plain(self, raw_value):
+        """Process a raw value without a unit string (`--format=csv,nounits`).
+
+        Same as `parse()` but skipping the removal of the unit string.
+
+        Parameters
+        ----------
+        raw_value : str
+            The value as reported by `nvidia-smi`.
+
+        Returns
+        -------
+        object or None
+            The processed value or `None` in case it's not supported or conversion
+            failed.
+        """
+        value = raw_value.strip()
+        if value == "[Not Supported]":
+            return None
+        if not self._convert:
+            return value
+
+        try:
+            return self._convert(value)
+        except ValueError:
+            # in case conversion fails with a `ValueError` disable the metric:
+            LOG.info("Converting value '%s' failed, disabling metric", value)
+        except Exception as err:  # pylint: disable-msg=broad-except
+            LOG.error("Error converting value '%s': %s", value, err)
+        return None
 
     @property
     def prometheus_name(self):
@@ -322,6 +546,37 @@ class NvMetric(object):
         """
         return int(value) * 1024 * 1024
 
+    @staticmethod
+    def convert_mhz(value):
+        """Transform a frequency given in megahertz into hertz.
+
+        Parameters
+        ----------
+        value : int
+            The value in megahertz.
+
+        Returns
+        -------
+        int
+            The value multiplied by 1000 * 1000
+        """
+        return int(value) * 1000 * 1000
+
+    @staticmethod
+    def convert_hex(value):
+        """Transform a hexadecimal string (e.g. `0x0000000000000004`) into an integer.
+
+        Parameters
+        ----------
+        value : str
+            The hexadecimal value, with or without the `0x` prefix.
+
+        Returns
+        -------
+        int
+        """
+        return int(value, 16)
+
     @staticmethod
     def convert_percent(value):
         """Transform a percentage value from 0-100 into a decimal ratio (0-1).
@@ -348,140 +603,3705 @@ class NvMetric(object):
         return '%s="%s"' % (self.prometheus_name, self.value)
 
 
-def process_gpu_metrics(values_from_csv, metric_collection):
-    """Process one line of (parsed) CSV output from an `nvidia-smi` query.
+class MetricSchema(object):
 
-    Parameters
+    """A compiled representation of a list of `NvMetric` definitions.
+
+    Building the schema once at startup precomputes everything that doesn't depend on
+    the actual values (conversion functions, metric names, '# HELP' and '# TYPE' lines,
+    label names), so processing a GPU's values boils down to a tight loop over plain
+    lists and tuples without having to copy or instantiate any metric objects.
+
+    Attributes
     ----------
-    values_from_csv : list(str)
-        A single line of the parsed CSV, obtained e.g. by a `csv.reader()` call.
-    metric_collection : PromMetricCollection
-        The collection object where processed metrics should be added to.
+    metrics : tuple(NvMetric)
+        The metric definitions the schema was compiled from.
+    names : tuple(str)
+        The property names, in the order used for querying `nvidia-smi`.
+    index : dict(int)
+        The position of each property, using the property name as the key.
+    parsers : tuple(callable)
+        The per-column functions to process raw `nvidia-smi` values (queried without
+        unit strings), see `NvMetric.parse_plain()` for details.
+    units : dict(str)
+        The unit `nvidia-smi` reports for each property (or `None`), using the property
+        name as the key.
+    labels : tuple(tuple)
+        A `(position, label_prefix, value_format)` tuple for each property used as a
+        label. If the PCI domain, bus and device are used as labels, the canonical
+        PCI bus ID (e.g. `00000000:83:00.0`, as reported by `nvidia-smi` and DCGM) is
+        added as the `pci_bus_id` label.
+    values : tuple(tuple)
+        A `(position, name, help_line, type_line, info_label)` tuple for each property
+        that results in a Prometheus metric. The `info_label` is `None` for numeric
+        properties or the label prefix for properties exported as `_info` metrics.
     """
-    LOG.info("*** processing GPU metrics ***")
-    LOG.debug("values_from_csv: %s", values_from_csv)
 
-    # first we create a deep-copy of the metrics objects to be absolutely sure we don't
-    # have any leftovers from previous calls:
-    metrics = copy.deepcopy(METRICS)
+    # the properties the PCI bus ID label is derived from:
+    BUS_ID = ("pci.domain", "pci.bus", "pci.device")
+
+    def __init__(self, metrics, use_as_label):
+        """Compile the schema.
+
+        Parameters
+        ----------
+        metrics : list(NvMetric)
+            The metric definitions.
+        use_as_label : list(str)
+            The names of the properties that should be used as labels.
+        """
+        self.metrics = tuple(metrics)
+        self.names = tuple(x.name for x in metrics)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.parsers = tuple(x.parse_plain for x in metrics)
+        self.units = dict((x.name, x.unit) for x in metrics)
+        self.labels = tuple(
+            (
+                self.index[name],
+                '%s="' % metrics[self.index[name]].prometheus_name,
+                metrics[self.index[name]].label_format,
+            )
+            for name in use_as_label
+        )
+        self._bus_id = None
+        if all(x in use_as_label for x in self.BUS_ID):
+            self._bus_id = tuple(self.index[x] for x in self.BUS_ID)
+        self._uuid_pos = self.index.get("gpu_uuid")
+        self._gpus = dict()
+
+        values = list()
+        for i, metric in enumerate(metrics):
+            # bitmasks are decoded separately (see `ThrottleReasons`):
+            if metric.name in use_as_label or metric.value_type == "bitmask":
+                continue
+            name = "nvsmi_" + metric.prometheus_name + metric.name_suffix
+            info_label = None
+            if metric.value_type == "str":
+                name += "_info"
+                info_label = ', %s="' % metric.prometheus_name
+            values.append(
+                (
+                    i,
+                    name,
+                    "# HELP %s %s" % (name, metric.description),
+                    "# TYPE %s gauge" % name,
+                    info_label,
+                )
+            )
+        self.values = tuple(values)
+
+    def parse_row(self, raw_values):
+        """Process the raw values of one GPU.
+
+        Parameters
+        ----------
+        raw_values : list(str)
+            A single line of the parsed CSV, obtained e.g. by `split_csv_line()`.
+
+        Returns
+        -------
+        list
+            The processed values, `None` for unsupported ones.
+        """
+        return [parse(raw) for parse, raw in zip(self.parsers, raw_values)]
+
+    def format_labels(self, row):
+        """Assemble the label string of one GPU (without using the cache).
+
+        Parameters
+        ----------
+        row : list
+            The processed values of the GPU, as returned by `parse_row()`.
+
+        Returns
+        -------
+        str
+            The labels, e.g. `gpu_name="Tesla M10", index="0", gpu_serial="123321"`.
+        """
+        labels = list()
+        for i, prefix, value_format in self.labels:
+            value = row[i]
+            if value is None:
+                value_format = "%s"
+            elif isinstance(value, str):
+                value = escape_label(value)
+            labels.append(prefix + value_format % value + '"')
+        if self._bus_id is not None:
+            bus_id = tuple(row[i] for i in self._bus_id)
+            if None not in bus_id:
+                labels.append('pci_bus_id="%08X:%02X:%02X.0"' % bus_id)
+        return ", ".join(labels)
+
+    def nlv_prefixes(self, labels):
+        """Assemble the beginning of the NLV string of each metric for a label string.
+
+        Parameters
+        ----------
+        labels : str
+            The label string, as returned by `format_labels()`.
+
+        Returns
+        -------
+        tuple(str)
+            The NLV string of each entry in `values` up to the value, e.g.
+            `nvsmi_power_draw_watts{index="0"} ` (or up to the opening quote of the
+            label value for `_info` metrics).
+        """
+        return tuple(
+            name + "{" + labels + ("} " if info_label is None else info_label)
+            for _, name, _, _, info_label in self.values
+        )
+
+    def gpu_entry(self, row):
+        """Get the cached label string and NLV prefixes of one GPU.
+
+        The cache uses the GPU's UUID as the key, an entry is only replaced when the
+        values of the labels (i.e. static properties) of the GPU change.
 
-    # create a shorthand-dict with our metric objects so we can access them by name:
-    metrics_by_name = dict()
-    for metric in metrics:
-        metrics_by_name[metric.name] = metric
+        Parameters
+        ----------
+        row : list
+            The processed values of the GPU, as returned by `parse_row()`.
+
+        Returns
+        -------
+        tuple
+            The label values, the label string (see `format_labels()`) and the NLV
+            prefixes (see `nlv_prefixes()`).
+        """
+        key = tuple([row[i] for i, _, _ in self.labels])
+        uuid = key if self._uuid_pos is None else row[self._uuid_pos]
+        entry = self._gpus.get(uuid)
+        if entry is None or entry[0] != key:
+            labels = self.format_labels(row)
+            entry = (key, labels, self.nlv_prefixes(labels))
+            self._gpus[uuid] = entry
+        return entry
+
+    def label_string(self, row):
+        """Get the label string of one GPU, formatted only once per GPU.
+
+        Parameters
+        ----------
+        row : list
+            The processed values of the GPU, as returned by `parse_row()`.
+
+        Returns
+        -------
+        str
+            See `format_labels()` for details.
+        """
+        return self.gpu_entry(row)[1]
+
+    def add_row(self, row, metric_collection):
+        """Add the processed values of one GPU to a metric collection.
+
+        Parameters
+        ----------
+        row : list
+            The processed values of the GPU, as returned by `parse_row()`.
+        metric_collection : PromMetricCollection
+            The collection object where the metrics should be added to.
+        """
+        prefixes = self.gpu_entry(row)[2]
+        add_line = metric_collection.add_line
+        for (i, name, help_line, type_line, info_label), prefix in zip(
+            self.values, prefixes
+        ):
+            value = row[i]
+            if value is None:  # e.g. the metric is not supported, failed parsing, ...
+                continue
+            if info_label is None:
+                add_line(name, help_line, type_line, prefix + str(value))
+            else:
+                nlv_string = prefix + escape_label(value) + '"} 1'
+                add_line(name, help_line, type_line, nlv_string)
 
-    # update the metric values from the given parsed CSV
-    for i, val in enumerate(values_from_csv):
-        metrics[i].value = val
 
-    # create a list of Prometheus-style label names from the NVIDIA SMI property names:
-    label_list = ["%s" % metrics_by_name[name] for name in USE_AS_LABEL]
-    label_string = ", ".join(label_list)
-    LOG.debug("label_string: %s", label_string)
+class Aggregator(object):
 
-    LOG.info(
-        ">>> Processed %s metrics for GPU %s, assembling Prometheus output...",
-        len(metrics),
-        metrics_by_name["index"].value,
+    """Running per-GPU aggregates of the numeric values of multiple samples.
+
+    Instead of the plain gauge, each numeric metric is exported as four series with the
+    suffixes `_min`, `_max`, `_avg` and `_last` covering all samples added since the
+    last call to `add_to()`. String properties (`_info` metrics), static properties
+    (exported as plain gauges, as they don't change between samples anyway) and labels
+    are taken from the last sample of each GPU.
+    """
+
+    SUFFIXES = (
+        ("_min", "minimum"),
+        ("_max", "maximum"),
+        ("_avg", "average"),
+        ("_last", "last value"),
     )
-    for metric in metrics:
-        if metric.name in USE_AS_LABEL:
-            continue
 
-        metric_collection.add(PromMetric.from_nv_metric(metric, label_string))
+    def __init__(self, schema):
+        """Initialize the aggregator.
 
+        Parameters
+        ----------
+        schema : MetricSchema
+            The schema describing the rows that will be added.
+        """
+        self.schema = schema
+        self._uuid_pos = schema.index["gpu_uuid"]
+        self._width = len(schema.names)
+        self._series = dict()
+        for i, name, _, _, info_label in schema.values:
+            if info_label is not None or schema.metrics[i].static:
+                continue
+            description = schema.metrics[i].description
+            series = list()
+            for suffix, kind in self.SUFFIXES:
+                series.append(
+                    (
+                        name + suffix,
+                        "# HELP %s%s %s (%s of samples)"
+                        % (name, suffix, description, kind),
+                        "# TYPE %s%s gauge" % (name, suffix),
+                    )
+                )
+            self._series[i] = series
+        self._gpus = dict()
 
-# the list of properties to query for using "nvidia-smi":
-METRICS = [
-    NvMetric("driver_version", "NVIDIA display driver version", "str"),
-    NvMetric("gpu_serial", "the serial number physically printed on the board", "str"),
-    NvMetric("gpu_uuid", "globally unique immutable alphanumeric identifier", "str"),
-    NvMetric("gpu_name", "official product name of the GPU", "str"),
-    NvMetric("index", "zero-based index of the GPU, can change at each boot", "int"),
-    NvMetric("utilization.gpu", "percent of time the GPU was busy", "pct"),
-    NvMetric("utilization.memory", "percent of time GPU RAM was read / written", "pct"),
-    NvMetric("memory.total", "total installed GPU RAM", "mb"),
-    NvMetric("memory.free", "total free GPU RAM", "mb"),
-    NvMetric("memory.used", "total GPU RAM used by active contexts", "mb"),
-    NvMetric("temperature.gpu", "core GPU temperature in degrees C", "degc"),
-    NvMetric("fan.speed", "intended (NOT MEASURED!) fan speed in percent", "pct"),
-    NvMetric("power.draw", "power draw for the entire board in Watts", "watt"),
-    NvMetric("power.limit", "software power limit in Watts", "watt"),
-    NvMetric("pci.domain", "PCI domain number", "hex"),
-    NvMetric("pci.bus", "PCI bus number", "hex"),
-    NvMetric("pci.device", "PCI device number", "hex"),
-    NvMetric("pci.device_id", "PCI vendor device id", "hex"),
-    NvMetric(
-        "pcie.link.gen.current",
-        "current PCI-E link generation in use with this GPU and system",
-        "int",
-    ),
-    NvMetric(
-        "pcie.link.gen.max",
-        "maximum PCI-E link generation possible with this GPU and system",
-        "int",
-    ),
-    NvMetric(
-        "pcie.link.width.current",
-        "current PCI-E link width in use with this GPU and system",
-        "int",
-    ),
-    NvMetric(
-        "pcie.link.width.max",
-        "maximum PCI-E link width possible with this GPU and system configuration",
-        "int",
-    ),
-]
+    def add(self, rows):
+        """Add a sample to the aggregates.
 
-# a list of PROPERTIES that should be used as labels for all Prometheus metrics:
-USE_AS_LABEL = [
-    "gpu_serial",
-    "gpu_name",
-    "gpu_uuid",
-    "index",
-    "pci.domain",
-    "pci.bus",
-    "pci.device",
-    "pci.device_id",
-]
+        Parameters
+        ----------
+        rows : list(list)
+            The processed values of all GPUs, one row per GPU.
+        """
+        for row in rows:
+            state = self._gpus.get(row[self._uuid_pos])
+            if state is None:
+                width = self._width
+                state = [row, [0] * width, [0] * width, [None] * width, [None] * width]
+                self._gpus[row[self._uuid_pos]] = state
+            state[0] = row
+            _, counts, sums, mins, maxs = state
+            for i in self._series:
+                value = row[i]
+                if value is None:
+                    continue
+                counts[i] += 1
+                sums[i] += value
+                if mins[i] is None or value < mins[i]:
+                    mins[i] = value
+                if maxs[i] is None or value > maxs[i]:
+                    maxs[i] = value
 
+    def add_to(self, metric_collection):
+        """Add the aggregated metrics to a collection and reset the aggregates.
 
-# create a list with the existing metric names:
-metrics_names = [x.name for x in METRICS]
+        Parameters
+        ----------
+        metric_collection : PromMetricCollection
+            The collection object where the metrics should be added to.
+        """
+        add_line = metric_collection.add_line
+        for last, counts, sums, mins, maxs in self._gpus.values():
+            labels = self.schema.label_string(last)
+            for i, name, help_line, type_line, info_label in self.schema.values:
+                if info_label is not None:
+                    if last[i] is not None:
+                        value = escape_label(last[i])
+                        nlv = '%s{%s%s%s"} 1' % (name, labels, info_label, value)
+                        add_line(name, help_line, type_line, nlv)
+                    continue
+                if i not in self._series:  # static property
+                    if last[i] is not None:
+                        nlv = "%s{%s} %s" % (name, labels, last[i])
+                        add_line(name, help_line, type_line, nlv)
+                    continue
+                if not counts[i]:
+                    continue
+                values = (mins[i], maxs[i], float(sums[i]) / counts[i], last[i])
+                for (name_s, help_s, type_s), value in zip(self._series[i], values):
+                    if value is None:
+                        continue
+                    nlv = "%s{%s} %s" % (name_s, labels, value)
+                    add_line(name_s, help_s, type_s, nlv)
 
-smi_cmd = [
-    "nvidia-smi",
-    "--query-gpu=%s" % ",".join(metrics_names),
-    "--format=csv",
-]
-LOG.info("call to `nvidia-smi`: <%s>", " ".join(smi_cmd))
+        self._gpus = dict()
 
 
-while True:
-    proc = subprocess.Popen(smi_cmd, stdout=subprocess.PIPE)
-    stdout = proc.communicate()[0].split("\n")
-    LOG.debug("result from `nvidia-smi`:\n----\n%s\n----\n", stdout)
+class ExporterStats(object):
 
-    header = stdout.pop(
-        0
-    )  # remove header but remember it (might be useful at some point)
-    LOG.debug("header line:\n----\n%s\n----\n", header)
+    """Self-instrumentation of the exporter, reported as `nvsmi_exporter_*` metrics.
 
-    collection = PromMetricCollection()
-    reader = csv.reader(stdout, delimiter=",")
-    for csv_line in reader:
-        if not csv_line:  # skip the line if its length is zero:
-            continue
+    The time spent in each phase of a collection cycle is accumulated through the
+    `timed()` context manager and reported (and reset) when calling `add_to()`. As the
+    formatting and writing happens after the metrics have been added to a collection,
+    those two phases are reported with the following cycle. The statistics are updated
+    from multiple threads (e.g. the sampler and the writer thread), so all changes are
+    made while holding a lock.
 
-        process_gpu_metrics(csv_line, collection)
+    Attributes
+    ----------
+    cycles : int
+        The number of completed collection cycles.
+    errors : int
+        The number of errors that occurred while collecting.
+    """
+
+    PHASES = (
+        ("smi", "running `nvidia-smi` (from spawn to exit)"),
+        ("nvml", "querying the NVML library"),
+        ("apps", "querying the compute processes"),
+        ("parse", "parsing the CSV output of `nvidia-smi`"),
+        ("process", "processing the values and assembling the metrics"),
+        ("render", "formatting the metrics"),
+        ("write", "writing the metrics"),
+    )
+
+    def __init__(self):
+        """Initialize the statistics."""
+        self.cycles = 0
+        self.errors = 0
+        self._durations = dict()
+        self._page_size = resource.getpagesize()
+        self._lock = threading.Lock()
+
+    def count_error(self):
+        """Increment the number of errors."""
+        with self._lock:
+            self.errors += 1
+
+    @contextmanager
+    def timed(self, phase):
+        """Context manager adding the time spent in its body to a phase's duration.
+
+        Parameters
+        ----------
+        phase : str
+            The phase name, one of the names in `PHASES`.
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            elapsed = monotonic() - start
+            with self._lock:
+                self._durations[phase] = self._durations.get(phase, 0.0) + elapsed
+
+    def resident_memory(self):
+        """Get the current resident set size of the process in bytes (Linux only).
+
+        Returns
+        -------
+        int or None
+        """
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * self._page_size
+        except (IOError, OSError, IndexError, ValueError):
+            return None
+
+    def add_to(self, metric_collection):
+        """Complete a cycle, adding the statistics to a metric collection.
+
+        Parameters
+        ----------
+        metric_collection : PromMetricCollection
+        """
+        with self._lock:
+            self.cycles += 1
+            cycles, errors = self.cycles, self.errors
+            durations = self._durations
+            self._durations = dict()
+
+        def add(name, description, value, metric_type="gauge"):
+            name = "nvsmi_exporter_" + name
+            metric_collection.add_line(
+                name,
+                "# HELP %s %s" % (name, description),
+                "# TYPE %s %s" % (name, metric_type),
+                "%s %s" % (name, value),
+            )
+
+        for phase, description in self.PHASES:
+            if phase in durations:
+                add(
+                    phase + "_seconds",
+                    "seconds spent %s in the last cycle" % description,
+                    durations[phase],
+                )
+        add("cycles_total", "completed collection cycles", cycles, "counter")
+        add("errors_total", "errors during collection", errors, "counter")
+
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        add(
+            "cpu_seconds_total",
+            "user and system CPU time of the exporter",
+            own.ru_utime + own.ru_stime,
+            "counter",
+        )
+        add(
+            "children_cpu_seconds_total",
+            "user and system CPU time of finished child processes (`nvidia-smi`)",
+            children.ru_utime + children.ru_stime,
+            "counter",
+        )
+        rss = self.resident_memory()
+        if rss is not None:
+            add("resident_memory_bytes", "resident memory size of the exporter", rss)
+
+
+class CollectionHealth(object):
+
+    """Track the success of collections, providing backoff and a circuit breaker.
+
+    After a failed collection the following attempts are skipped with an exponentially
+    growing backoff, once `threshold` consecutive failures have occurred the circuit
+    is "open" and only one attempt per `max_skip` runs is made, until a collection is
+    successful again. The state is reported as `nvsmi_up` and
+    `nvsmi_last_success_timestamp_seconds` so stale metrics are clearly visible.
+
+    Attributes
+    ----------
+    failures : int
+        The number of consecutive failed collections.
+    last_success : float or None
+        The (wall-clock) timestamp of the last successful collection.
+    """
+
+    def __init__(self, max_skip, threshold):
+        """Initialize the health state.
+
+        Parameters
+        ----------
+        max_skip : int
+            The maximum number of runs to skip between two attempts.
+        threshold : int
+            The number of consecutive failures after which the circuit opens.
+        """
+        self.max_skip = max_skip
+        self.threshold = threshold
+        self.failures = 0
+        self.last_success = None
+        self._skip = 0
+
+    def allow(self):
+        """Check if a collection should be attempted in this run.
+
+        Returns
+        -------
+        bool
+        """
+        if self._skip > 0:
+            self._skip -= 1
+            LOG.debug("Backing off, %s more run(s) will be skipped", self._skip)
+            return False
+        return True
+
+    def success(self):
+        """Record a successful collection."""
+        if self.failures:
+            LOG.warning("Collection recovered after %s failure(s)", self.failures)
+        self.failures = 0
+        self._skip = 0
+        self.last_success = time.time()
+
+    def failure(self):
+        """Record a failed collection and compute the backoff."""
+        self.failures += 1
+        if self.failures >= self.threshold:
+            LOG.error("%s consecutive failures, circuit is open", self.failures)
+            self._skip = self.max_skip
+        else:
+            self._skip = min(2 ** (self.failures - 1) - 1, self.max_skip)
+
+    def add_to(self, metric_collection):
+        """Add the health state to a metric collection.
+
+        Parameters
+        ----------
+        metric_collection : PromMetricCollection
+        """
+        name = "nvsmi_up"
+        metric_collection.add_line(
+            name,
+            "# HELP %s whether the last collection was successful" % name,
+            "# TYPE %s gauge" % name,
+            "%s %s" % (name, 0 if self.failures else 1),
+        )
+        if self.last_success is None:
+            return
+        name = "nvsmi_last_success_timestamp_seconds"
+        metric_collection.add_line(
+            name,
+            "# HELP %s time of the last successful collection" % name,
+            "# TYPE %s gauge" % name,
+            "%s %s" % (name, self.last_success),
+        )
+
+
+def utf8_bytes(text):
+    """Encode a string as UTF-8, unless it's a byte string already.
+
+    On Python 2 most strings (e.g. the output of `nvidia-smi`) are byte strings, calling
+    `encode()` on them would decode them as ASCII first and fail for any other value.
+
+    Parameters
+    ----------
+    text : str, bytes or unicode
+
+    Returns
+    -------
+    bytes
+    """
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+
+class TextfileWriter(object):
+
+    """Atomic writer for textfiles.
+
+    The content is written to a temporary file in the same directory which is then
+    renamed to the target name, so readers (e.g. the `textfile` collector) never see a
+    partially written file.
+
+    Attributes
+    ----------
+    filename : str
+        The path of the file to write.
+    fsync : bool
+        Flag to flush the file and the directory entry to disk on each write.
+    """
+
+    def __init__(self, filename, fsync=False):
+        """Initialize the writer.
+
+        Parameters
+        ----------
+        filename : str
+            See the class attributes for details.
+        fsync : bool, optional
+            See the class attributes for details, by default False.
+        """
+        self.filename = filename
+        self.fsync = fsync
+        # `writev` fails with EINVAL if given more than IOV_MAX buffers:
+        try:
+            self._iov_max = os.sysconf("SC_IOV_MAX")
+        except (AttributeError, ValueError, OSError):
+            self._iov_max = -1
+        if self._iov_max <= 0:
+            self._iov_max = 1024
+
+    def write(self, chunks):
+        """Write the given chunks.
+
+        Parameters
+        ----------
+        chunks : list(str)
+            The content of the file, e.g. as returned by
+            `PromMetricCollection.chunks()`.
+        """
+        import tempfile  # pylint: disable-msg=import-outside-toplevel
+
+        encoded = [utf8_bytes(x) for x in chunks]
+        dirname = path.dirname(self.filename) or "."
+        fd, tmpname = tempfile.mkstemp(prefix=".nvsmi-", suffix=".tmp", dir=dirname)
+        try:
+            # `mkstemp` creates the file with mode 0600, the collector needs to read it:
+            os.fchmod(fd, 0o644)
+            self._write_all(fd, encoded)
+            if self.fsync:
+                os.fsync(fd)
+            os.close(fd)
+            fd = None
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError):
+            if fd is not None:
+                os.close(fd)
+            os.unlink(tmpname)
+            raise
+
+        if self.fsync:
+            dirfd = os.open(dirname, os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+
+    def _write_all(self, fd, encoded):
+        """Write all encoded chunks to a file descriptor, in batches of IOV_MAX."""
+        writev = getattr(os, "writev", None)
+        pending = list(encoded) if writev else [b"".join(encoded)]  # Python 2
+        pos = 0
+        while pos < len(pending):
+            if writev:
+                written = writev(fd, pending[pos : pos + self._iov_max])
+            else:
+                written = os.write(fd, pending[pos])
+            # skip the chunks written completely, keep the tail of a partial one:
+            while pos < len(pending) and written >= len(pending[pos]):
+                written -= len(pending[pos])
+                pos += 1
+            if written:
+                pending[pos] = pending[pos][written:]
+
+
+class SnapshotBuffer(object):
+
+    """Bounded double buffer handing metric snapshots from a sampler to a writer thread.
+
+    The buffer holds at most two snapshots: the one currently being written (the back
+    buffer) and the latest one waiting to be written (the front buffer). Putting a new
+    snapshot while another one is still waiting replaces (drops) the waiting one, so the
+    sampler never blocks and the writer always continues with the latest snapshot. A
+    snapshot must not be modified anymore once it has been put into the buffer.
+
+    Attributes
+    ----------
+    dropped : int
+        The total number of snapshots that were replaced before being written.
+    """
+
+    def __init__(self):
+        """Initialize an empty buffer."""
+        self.dropped = 0
+        self._pending = None
+        self._busy = False
+        self._cond = threading.Condition()
+
+    def depth(self):
+        """Get the number of snapshots waiting or being written (0 to 2).
+
+        Returns
+        -------
+        int
+        """
+        return int(self._pending is not None) + int(self._busy)
+
+    def put(self, snapshot):
+        """Hand over a snapshot to the writer, replacing a still waiting one.
+
+        Parameters
+        ----------
+        snapshot : object
+        """
+        with self._cond:
+            if self._pending is not None:
+                self.dropped += 1
+                LOG.debug("Writer is lagging behind, dropped a snapshot")
+            self._pending = snapshot
+            self._cond.notify_all()
+
+    def take(self):
+        """Wait for the next snapshot, `done()` has to be called once it's written.
+
+        Returns
+        -------
+        object
+        """
+        with self._cond:
+            while self._pending is None:
+                self._cond.wait()
+            snapshot = self._pending
+            self._pending = None
+            self._busy = True
+            return snapshot
+
+    def done(self):
+        """Mark the snapshot returned by the last call to `take()` as written."""
+        with self._cond:
+            self._busy = False
+            self._cond.notify_all()
+
+    def drain(self, timeout):
+        """Wait until all snapshots have been written, e.g. before exiting.
+
+        Parameters
+        ----------
+        timeout : float
+            The maximum number of seconds to wait.
+
+        Returns
+        -------
+        bool
+            True if the buffer is empty, False if the timeout expired.
+        """
+        deadline = monotonic() + timeout
+        with self._cond:
+            while self.depth():
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    LOG.warning("Timed out waiting for the metrics to be written")
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def add_to(self, metric_collection):
+        """Add the queue depth and the number of dropped snapshots to a collection.
+
+        Parameters
+        ----------
+        metric_collection : PromMetricCollection
+        """
+        for name, description, value, metric_type in (
+            (
+                "write_queue_depth",
+                "snapshots waiting or being written",
+                self.depth(),
+                "gauge",
+            ),
+            (
+                "snapshots_dropped_total",
+                "snapshots replaced by a newer one before being written",
+                self.dropped,
+                "counter",
+            ),
+        ):
+            name = "nvsmi_exporter_" + name
+            metric_collection.add_line(
+                name,
+                "# HELP %s %s" % (name, description),
+                "# TYPE %s %s" % (name, metric_type),
+                "%s %s" % (name, value),
+            )
+
+
+class StaticFieldCache(object):
+
+    """Cache for the static properties of each GPU, using the GPU's UUID as the key.
+
+    Properties flagged as `static` (almost) never change, so they are only queried at
+    startup, every `refresh` seconds and whenever an unknown GPU shows up. The frequent
+    queries only request the dynamic properties (plus the UUID for joining), which
+    reduces the work of `nvidia-smi` as well as the parsing effort.
+
+    Properties that are not supported by the GPUs can be left out of the queries
+    entirely through `prune()`, their values are `None` in the processed rows.
+
+    Attributes
+    ----------
+    schema : MetricSchema
+        The schema describing the complete set of properties.
+    query_names : list(str)
+        The properties to request in the frequent queries.
+    static_names : list(str)
+        The properties to request in the (rare) static queries. Empty if `refresh`
+        is 0, in which case `query_names` contains all (supported) properties.
+    probe : CapabilityProbe or None
+        If set, the probe is re-run (and the properties pruned accordingly) whenever
+        the driver version or the GPU models change.
+    """
+
+    def __init__(self, schema, refresh):
+        """Initialize the cache (the static properties are queried lazily).
+
+        Parameters
+        ----------
+        schema : MetricSchema
+            See the class attributes for details.
+        refresh : int
+            Seconds after which the static properties are queried again, 0 disables
+            the split between static and dynamic properties.
+        """
+        self.schema = schema
+        self.refresh = refresh
+        self.probe = None
+        self._by_uuid = dict()
+        self._next_refresh = 0
+        self.prune(())
+
+    def prune(self, unsupported):
+        """Set the properties to query for, leaving out the unsupported ones.
+
+        Parameters
+        ----------
+        unsupported : set(str)
+            The names of the properties not to query for.
+        """
+        schema = self.schema
+        metrics = [x for x in schema.metrics if x.name not in unsupported]
+        if self.refresh:
+            self.static_names = [x.name for x in metrics if x.static]
+            self.query_names = ["gpu_uuid"] + [x.name for x in metrics if not x.static]
+        else:
+            self.static_names = list()
+            self.query_names = [x.name for x in metrics]
+        self._complete = self.query_names == list(schema.names)
+        self._query_positions = [schema.index[x] for x in self.query_names]
+        self._query_parsers = [schema.parsers[x] for x in self._query_positions]
+        self._static_positions = [schema.index[x] for x in self.static_names]
+        self._static_parsers = [schema.parsers[x] for x in self._static_positions]
+        # the cached static values have to be re-queried with the new properties:
+        self._next_refresh = 0
+
+    def update(self):
+        """Query the static properties of all GPUs and replace the cached values."""
+        LOG.info("Querying static properties: %s", ",".join(self.static_names))
+        uuid_pos = self.schema.index["gpu_uuid"]
+        by_uuid = dict()
+        for raw_values in poll_smi(self.static_names):
+            row = [None] * len(self.schema.names)
+            for pos, parse, raw in zip(
+                self._static_positions, self._static_parsers, raw_values
+            ):
+                row[pos] = parse(raw)
+            by_uuid[row[uuid_pos]] = row
+        self._by_uuid = by_uuid
+        self._next_refresh = monotonic() + self.refresh
+
+    def merge(self, raw_rows):
+        """Process the raw rows of a frequent query and add the static properties.
+
+        Parameters
+        ----------
+        raw_rows : list(list(str))
+            The parsed CSV rows of a query for `query_names`, one per GPU.
+
+        Returns
+        -------
+        list(list)
+            The processed values of all GPUs (ordered like `schema.names`).
+        """
+        with STATS.timed("process"):
+            return self._merge(raw_rows)
+
+    def _merge(self, raw_rows):
+        """Implementation of `merge()` (without the timing)."""
+        if self._complete:
+            rows = [self.schema.parse_row(x) for x in raw_rows]
+        else:
+            rows = self._join(raw_rows)
+        if self.probe is not None and self.probe.changed(rows):
+            self.prune(self.probe.run())
+        return rows
+
+    def _join(self, raw_rows):
+        """Process the raw rows of a query for a subset of the properties.
+
+        The values of the static properties are added from the cache (if the static
+        properties are queried separately), all others are left at `None`.
+        """
+        width = len(self.schema.names)
+        uuid_pos = self.query_names.index("gpu_uuid")
+        uuids = [x[uuid_pos].strip() for x in raw_rows]
+        if self.static_names and (
+            monotonic() >= self._next_refresh
+            or not all(x in self._by_uuid for x in uuids)
+        ):
+            self.update()
+
+        empty = [None] * width
+        rows = list()
+        for uuid, raw_values in zip(uuids, raw_rows):
+            static = self._by_uuid.get(uuid)
+            if static is None:
+                if self.static_names:
+                    LOG.warning("No static properties found for GPU %s", uuid)
+                static = empty
+            row = list(static)
+            for pos, parse, raw in zip(
+                self._query_positions, self._query_parsers, raw_values
+            ):
+                row[pos] = parse(raw)
+            rows.append(row)
+        return rows
+
+
+class CapabilityProbe(object):
+
+    """Determine the properties that are not supported by the installed GPUs.
+
+    A single query for all properties is made and the ones reported as "[Not
+    Supported]" by all GPUs of a model are recorded for that model. The results are
+    cached per driver version and GPU model (in memory and optionally in a file), so
+    the probe query is only made for unknown combinations. Only properties that are
+    unsupported by all installed GPUs are reported, so they can be left out of the
+    queries entirely.
+
+    Attributes
+    ----------
+    schema : MetricSchema
+        The schema describing the complete set of properties.
+    key : tuple or None
+        The driver version and the GPU models the last result is valid for.
+    """
+
+    # properties that are required for processing the rows, never to be pruned:
+    REQUIRED = ("gpu_uuid", "driver_version", "gpu_name")
+
+    def __init__(self, schema, cache_file=""):
+        """Initialize the probe, loading the cache file (if any).
+
+        Parameters
+        ----------
+        schema : MetricSchema
+            See the class attributes for details.
+        cache_file : str, optional
+            The file to cache the results in, by default "" (no file).
+        """
+        self.schema = schema
+        self.key = None
+        self._driver_pos = schema.index["driver_version"]
+        self._name_pos = schema.index["gpu_name"]
+        self._writer = TextfileWriter(cache_file) if cache_file else None
+        self._cache = dict()  # driver version -> {GPU model: [unsupported properties]}
+        if self._writer is not None:
+            import json  # pylint: disable-msg=import-outside-toplevel
+
+            try:
+                with open(cache_file) as cachefile:
+                    self._cache = json.load(cachefile)
+            except (IOError, OSError, ValueError) as err:
+                LOG.info("Not loading capabilities from [%s]: %s", cache_file, err)
+
+    def changed(self, rows):
+        """Check if the driver version or the GPU models differ from the last run.
+
+        Parameters
+        ----------
+        rows : list(list)
+            The processed values of all GPUs, one row per GPU.
+
+        Returns
+        -------
+        bool
+        """
+        if not rows:
+            return False
+        models = tuple(sorted(set(x[self._name_pos] for x in rows)))
+        if (rows[0][self._driver_pos], models) == self.key:
+            return False
+        LOG.warning("Driver version or GPU models changed, probing properties")
+        return True
+
+    def run(self):
+        """Determine the unsupported properties, probing them only if necessary.
+
+        Returns
+        -------
+        set(str)
+            The names of the properties not supported by any of the GPUs. Empty in
+            case probing failed.
+        """
+        try:
+            raw_rows = poll_smi(["driver_version", "gpu_name"])
+            driver = raw_rows[0][0].strip() if raw_rows else ""
+            models = tuple(sorted(set(x[1].strip() for x in raw_rows)))
+            known = self._cache.get(driver, dict())
+            if not all(x in known for x in models):
+                known = self.probe(driver)
+        except SmiError as err:
+            LOG.error("Probing the supported properties failed: %s", err)
+            STATS.count_error()
+            return set()
+
+        self.key = (driver, models)
+        unsupported = None
+        for model in models:
+            fields = set(known.get(model, list()))
+            unsupported = fields if unsupported is None else unsupported & fields
+        unsupported = (unsupported or set()).difference(self.REQUIRED)
+        if unsupported:
+            LOG.info("Not querying unsupported: %s", ",".join(sorted(unsupported)))
+        return unsupported
+
+    def probe(self, driver):
+        """Query all properties and record the unsupported ones per GPU model.
+
+        Parameters
+        ----------
+        driver : str
+            The driver version to record the results for.
+
+        Returns
+        -------
+        dict(list)
+            The unsupported properties for the driver version, using the GPU model as
+            the key.
+
+        Raises
+        ------
+        SmiError
+            Raised in case the query timed out or failed.
+        """
+        LOG.info("Probing the supported properties for driver %s", driver)
+        names = list(self.schema.names)
+        models = dict()
+        for raw_values in poll_smi(names):
+            model = raw_values[self._name_pos].strip()
+            unsupported = set(
+                name
+                for name, raw in zip(names, raw_values)
+                if raw.strip() == "[Not Supported]"
+            )
+            models[model] = models.get(model, unsupported) & unsupported
+
+        known = self._cache.setdefault(driver, dict())
+        for model, unsupported in models.items():
+            known[model] = sorted(unsupported)
+        if self._writer is not None:
+            import json  # pylint: disable-msg=import-outside-toplevel
+
+            try:
+                self._writer.write([json.dumps(self._cache, sort_keys=True)])
+            except (IOError, OSError) as err:
+                LOG.error("Caching capabilities failed: %s", err)
+        return known
+
+
+class IntegratedCounters(object):
+
+    """Monotonic counters integrated from sampled gauges, e.g. energy from power draw.
+
+    Between two samples of a GPU the gauge is integrated over (monotonic) time using
+    the trapezoidal rule, so `rate()` on the resulting counters is accurate no matter
+    how the sampling and scrape intervals relate. Gaps longer than `max_gap` seconds
+    (e.g. while `nvidia-smi` was failing) are not integrated. Each counter has a
+    `_created` series holding the time it was first seen, the totals and creation
+    times are written to a state file (if given) and loaded from there on startup.
+
+    Attributes
+    ----------
+    schema : MetricSchema
+        The schema describing the rows that will be added.
+    max_gap : float
+        The maximum number of seconds between two samples to integrate over.
+    """
+
+    # (property, metric name, description) of each counter:
+    COUNTERS = (
+        (
+            "power.draw",
+            "nvsmi_energy_joules_total",
+            "energy consumed by the board (integrated power draw)",
+        ),
+        (
+            "utilization.gpu",
+            "nvsmi_busy_seconds_total",
+            "time the GPU was busy (integrated utilization)",
+        ),
+    )
+
+    def __init__(self, schema, max_gap, state_file=""):
+        """Initialize the counters, loading the state file (if any).
+
+        Parameters
+        ----------
+        schema : MetricSchema
+            See the class attributes for details.
+        max_gap : float
+            See the class attributes for details.
+        state_file : str, optional
+            The file to persist the counters in, by default "" (no persistence).
+        """
+        self.schema = schema
+        self.max_gap = max_gap
+        self._uuid_pos = schema.index["gpu_uuid"]
+        self._positions = [schema.index[x[0]] for x in self.COUNTERS]
+        self._writer = TextfileWriter(state_file) if state_file else None
+        self._last = dict()  # uuid -> (timestamp, row)
+        self._totals = dict()  # uuid -> {name: [total, created]}
+        if self._writer is not None:
+            self._load(state_file)
+
+    def _load(self, state_file):
+        """Load the totals from the state file (if it exists)."""
+        import json  # pylint: disable-msg=import-outside-toplevel
+
+        try:
+            with open(state_file) as statefile:
+                self._totals = json.load(statefile)
+            LOG.info("Loaded counters for %s GPU(s)", len(self._totals))
+        except (IOError, OSError, ValueError) as err:
+            LOG.info("Not loading counters from [%s]: %s", state_file, err)
+
+    def add(self, rows):
+        """Integrate the values of a sample.
+
+        Parameters
+        ----------
+        rows : list(list)
+            The processed values of all GPUs, one row per GPU.
+        """
+        now = monotonic()
+        self._forget_missing(rows)
+        for row in rows:
+            uuid = row[self._uuid_pos]
+            totals = self._totals.get(uuid)
+            if totals is None:
+                created = time.time()
+                totals = dict((x[1], [0.0, created]) for x in self.COUNTERS)
+                self._totals[uuid] = totals
+            previous = self._last.get(uuid)
+            self._last[uuid] = (now, row)
+            if previous is None:
+                continue
+            elapsed = now - previous[0]
+            if elapsed <= 0 or elapsed > self.max_gap:
+                continue
+            for pos, (_, name, _) in zip(self._positions, self.COUNTERS):
+                if row[pos] is None or previous[1][pos] is None:
+                    continue
+                totals[name][0] += (row[pos] + previous[1][pos]) / 2.0 * elapsed
+
+    def _forget_missing(self, rows):
+        """Drop the state of all GPUs missing from a sample (e.g. removed ones)."""
+        present = set(x[self._uuid_pos] for x in rows)
+        for uuid in [x for x in self._totals if x not in present]:
+            LOG.info("GPU [%s] is gone, dropping its counters", uuid)
+            del self._totals[uuid]
+            self._last.pop(uuid, None)
+
+    def add_to(self, metric_collection):
+        """Add the counters of all sampled GPUs to a collection and save the state.
+
+        Parameters
+        ----------
+        metric_collection : PromMetricCollection
+        """
+        add_line = metric_collection.add_line
+        for uuid, (_, row) in self._last.items():
+            labels = self.schema.label_string(row)
+            for _, name, description in self.COUNTERS:
+                total, created = self._totals[uuid][name]
+                add_line(
+                    name,
+                    "# HELP %s %s" % (name, description),
+                    "# TYPE %s counter" % name,
+                    "%s{%s} %s" % (name, labels, total),
+                )
+                created_name = name[: -len("_total")] + "_created"
+                add_line(
+                    created_name,
+                    "# HELP %s creation time of %s" % (created_name, name),
+                    "# TYPE %s gauge" % created_name,
+                    "%s{%s} %s" % (created_name, labels, created),
+                )
+
+        if self._writer is None:
+            return
+        import json  # pylint: disable-msg=import-outside-toplevel
+
+        try:
+            self._writer.write([json.dumps(self._totals, sort_keys=True)])
+        except (IOError, OSError) as err:
+            LOG.error("Saving counters to [%s] failed: %s", self._writer.filename, err)
+            STATS.count_error()
+
+
+class ThrottleReasons(object):
+
+    """Decoder for the bitmask of the reasons the clocks are currently throttled.
+
+    The bitmask (`clocks_throttle_reasons.active`) of each GPU is decoded into one
+    boolean gauge per reason, `nvsmi_throttle_active{reason="..."}`, reflecting the
+    last sample. In addition the time each reason was active is accumulated in
+    `nvsmi_throttle_seconds_total{reason="..."}`, integrated between two samples the
+    same way the `IntegratedCounters` do - the higher the sampling rate (e.g. through
+    SAMPLE_MS or LOOP_MS) the more accurate. The counters are kept in memory only.
+
+    Attributes
+    ----------
+    schema : MetricSchema
+        The schema describing the rows that will be added.
+    max_gap : float
+        The maximum number of seconds between two samples to integrate over.
+    counter : bool
+        Flag to export the counters, e.g. disabled for single runs, where nothing is
+        ever integrated and the counters would always report zero.
+    """
+
+    PROPERTY = "clocks_throttle_reasons.active"
+
+    # the bits of the mask as defined by NVML (`nvmlClocksThrottleReason*`):
+    REASONS = (
+        (0x1, "gpu_idle"),
+        (0x2, "applications_clocks_setting"),
+        (0x4, "sw_power_cap"),
+        (0x8, "hw_slowdown"),
+        (0x10, "sync_boost"),
+        (0x20, "sw_thermal_slowdown"),
+        (0x40, "hw_thermal_slowdown"),
+        (0x80, "hw_power_brake_slowdown"),
+        (0x100, "display_clock_setting"),
+    )
+
+    GAUGE = "nvsmi_throttle_active"
+    COUNTER = "nvsmi_throttle_seconds_total"
+
+    def __init__(self, schema, max_gap, counter=True):
+        """Initialize the decoder.
+
+        Parameters
+        ----------
+        schema : MetricSchema
+            See the class attributes for details, has to contain `PROPERTY`.
+        max_gap : float
+            See the class attributes for details.
+        counter : bool, optional
+            See the class attributes for details, by default True.
+        """
+        self.schema = schema
+        self.max_gap = max_gap
+        self.counter = counter
+        self._uuid_pos = schema.index["gpu_uuid"]
+        self._pos = schema.index[self.PROPERTY]
+        self._last = dict()  # uuid -> (timestamp, row)
+        self._totals = dict()  # uuid -> [seconds of each reason]
+
+    def add(self, rows):
+        """Integrate the active reasons of a sample.
+
+        Parameters
+        ----------
+        rows : list(list)
+            The processed values of all GPUs, one row per GPU.
+        """
+        now = monotonic()
+        # drop the state of all GPUs missing from the sample (e.g. removed ones):
+        present = set(x[self._uuid_pos] for x in rows)
+        for uuid in [x for x in self._last if x not in present]:
+            del self._last[uuid]
+            self._totals.pop(uuid, None)
+        for row in rows:
+            uuid = row[self._uuid_pos]
+            mask = row[self._pos]
+            previous = self._last.get(uuid)
+            self._last[uuid] = (now, row)
+            if mask is None:
+                continue
+            totals = self._totals.get(uuid)
+            if totals is None:
+                totals = [0.0] * len(self.REASONS)
+                self._totals[uuid] = totals
+            if previous is None or previous[1][self._pos] is None:
+                continue
+            elapsed = now - previous[0]
+            if elapsed <= 0 or elapsed > self.max_gap:
+                continue
+            # only the reasons active in any of the two samples need to be checked:
+            either = mask | previous[1][self._pos]
+            for i, (bit, _) in enumerate(self.REASONS):
+                if either & bit:
+                    active = bool(mask & bit) + bool(previous[1][self._pos] & bit)
+                    totals[i] += active / 2.0 * elapsed
+
+    def add_to(self, metric_collection):
+        """Add the decoded reasons and the counters of all GPUs to a collection.
+
+        Parameters
+        ----------
+        metric_collection : PromMetricCollection
+        """
+        add_line = metric_collection.add_line
+        gauge_lines = (
+            "# HELP %s whether the clocks are throttled for the reason" % self.GAUGE,
+            "# TYPE %s gauge" % self.GAUGE,
+        )
+        counter_lines = (
+            "# HELP %s time the clocks were throttled for the reason" % self.COUNTER,
+            "# TYPE %s counter" % self.COUNTER,
+        )
+        for uuid, (_, row) in self._last.items():
+            mask = row[self._pos]
+            if mask is None:
+                continue
+            labels = self.schema.label_string(row)
+            for (bit, reason), total in zip(self.REASONS, self._totals[uuid]):
+                add_line(
+                    self.GAUGE,
+                    gauge_lines[0],
+                    gauge_lines[1],
+                    '%s{%s, reason="%s"} %s'
+                    % (self.GAUGE, labels, reason, 1 if mask & bit else 0),
+                )
+                if not self.counter:
+                    continue
+                add_line(
+                    self.COUNTER,
+                    counter_lines[0],
+                    counter_lines[1],
+                    '%s{%s, reason="%s"} %s' % (self.COUNTER, labels, reason, total),
+                )
+
+
+def escape_label(value):
+    """Escape a string for use as a Prometheus label value.
+
+    Parameters
+    ----------
+    value : str
+
+    Returns
+    -------
+    str
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class JobResolver(object):
+
+    """Resolve PIDs into the job (Slurm), pod (Kubernetes) and user owning them.
+
+    The information is derived from the process' cgroup membership and status in the
+    `/proc` filesystem. The results are cached per PID together with the process'
+    start time, so a PID being reused by a different process is detected and resolved
+    again. Entries for PIDs that have disappeared are removed through `prune()`.
+
+    Attributes
+    ----------
+    proc_root : str
+        The location of the `proc` filesystem (may be a fake tree for testing).
+    """
+
+    LABELS = ("job_id", "pod_uid", "user")
+
+    # e.g. `/slurm/uid_1000/job_123/step_0` or `/system.slice/slurmstepd.scope/job_123`,
+    # on any line of the (cgroup v1) file:
+    SLURM_JOB = re.compile(r"/job_(\d+)(?:/|$)", re.M)
+
+    # e.g. `/kubepods/burstable/pod<uid>/...` or `kubepods-burstable-pod<uid>.slice`
+    # (the systemd cgroup driver replaces the dashes of the UID by underscores):
+    K8S_POD = re.compile(
+        r"pod([0-9a-f]{8}[-_][0-9a-f]{4}[-_][0-9a-f]{4}[-_][0-9a-f]{4}[-_][0-9a-f]{12})"
+    )
+
+    def __init__(self, proc_root="/proc"):
+        """Initialize the resolver.
+
+        Parameters
+        ----------
+        proc_root : str, optional
+            See the class attributes for details, by default "/proc".
+        """
+        import pwd  # pylint: disable-msg=import-outside-toplevel
+
+        self.proc_root = proc_root
+        self._cache = dict()
+        self._getpwuid = pwd.getpwuid
+
+    def _read(self, pid, name):
+        """Read a file from a process' `/proc` directory, `None` if that fails."""
+        try:
+            with open(path.join(self.proc_root, pid, name)) as procfile:
+                return procfile.read()
+        except (IOError, OSError):
+            return None
+
+    def start_time(self, pid):
+        """Get the start time of a process (in clock ticks since boot).
+
+        Parameters
+        ----------
+        pid : str
+
+        Returns
+        -------
+        str or None
+            The start time or `None` if the process doesn't exist (any more).
+        """
+        stat = self._read(pid, "stat")
+        if stat is None:
+            return None
+        # the command name (2nd field) may contain spaces and parentheses:
+        fields = stat.rsplit(")", 1)[-1].split()
+        if len(fields) < 20:
+            return None
+        return fields[19]
+
+    def resolve(self, pid):
+        """Get the job labels of a process, using the cache if possible.
+
+        Parameters
+        ----------
+        pid : str
+
+        Returns
+        -------
+        str
+            The label string, e.g. `job_id="123", pod_uid="", user="jdoe"`.
+        """
+        start = self.start_time(pid)
+        cached = self._cache.get(pid)
+        if cached is not None and start is not None and cached[0] == start:
+            return cached[1]
+
+        values = self.job_values(pid)
+        labels = ", ".join(
+            ['%s="%s"' % (x, escape_label(y)) for x, y in zip(self.LABELS, values)]
+        )
+        if start is not None:
+            self._cache[pid] = (start, labels)
+        return labels
+
+    def job_values(self, pid):
+        """Determine the job ID, pod UID and user of a process (without caching).
+
+        Parameters
+        ----------
+        pid : str
+
+        Returns
+        -------
+        tuple(str)
+            The values for the labels in `LABELS`, empty strings for unknown ones.
+        """
+        job_id = pod_uid = user = ""
+        cgroup = self._read(pid, "cgroup") or ""
+        match = self.SLURM_JOB.search(cgroup)
+        if match:
+            job_id = match.group(1)
+        match = self.K8S_POD.search(cgroup)
+        if match:
+            pod_uid = match.group(1).replace("_", "-")
+
+        for line in (self._read(pid, "status") or "").split("\n"):
+            if line.startswith("Uid:"):
+                uid = int(line.split()[1])
+                try:
+                    user = self._getpwuid(uid).pw_name
+                except KeyError:
+                    user = str(uid)
+                break
+        return job_id, pod_uid, user
+
+    def prune(self, pids):
+        """Remove the cache entries of all processes not in the given ones.
+
+        Parameters
+        ----------
+        pids : set(str)
+            The PIDs of the currently running processes.
+        """
+        for pid in [x for x in self._cache if x not in pids]:
+            del self._cache[pid]
+
+
+class ProcessCollector(object):
+
+    """Collector for the GPU memory used by each process (`--query-compute-apps`).
+
+    The processes are reported as `nvsmi_process_used_memory_bytes`, carrying the
+    labels of the GPU they are running on (joined by the GPU's UUID) plus their PID
+    and name (and optionally the job owning them, see `JobResolver`). To keep the
+    number of series bounded on busy nodes, at most `max_series` processes are
+    reported. The identities of the reported series are tracked in LRU order: processes
+    that have already been reported are preferred over new ones and the least recently
+    seen ones are evicted once the limit is exceeded.
+
+    Attributes
+    ----------
+    max_series : int
+        The maximum number of process series to report.
+    gpu_labels : dict(str)
+        The label string of each GPU, using the GPU's UUID as the key.
+    jobs : JobResolver or None
+        The resolver for the job labels, `None` to omit them.
+    dropped : int
+        The total number of process series omitted due to the limit.
+    """
+
+    FIELDS = ["pid", "process_name", "gpu_uuid", "used_memory"]
+    UNITS = {"used_memory": "MiB"}
+
+    def __init__(self, max_series, jobs=None):
+        """Initialize the collector.
+
+        Parameters
+        ----------
+        max_series : int
+            See the class attributes for details.
+        jobs : JobResolver, optional
+            See the class attributes for details, by default None.
+        """
+        self.max_series = max_series
+        self.jobs = jobs
+        self.gpu_labels = dict()
+        self.dropped = 0
+        self._known = collections.OrderedDict()
+
+    def update_labels(self, rows):
+        """Update the GPU labels from the processed values of the GPUs.
+
+        Parameters
+        ----------
+        rows : list(list)
+            The processed values, one row per GPU (ordered like `SCHEMA.names`).
+        """
+        uuid_pos = SCHEMA.index["gpu_uuid"]
+        for row in rows:
+            self.gpu_labels[row[uuid_pos]] = SCHEMA.label_string(row)
+
+    def query(self):
+        """Query the compute processes of all GPUs.
+
+        Returns
+        -------
+        list(tuple)
+            A `(pid, process_name, gpu_uuid, used_bytes)` tuple for each process
+            having a GPU context, `used_bytes` is `None` if it's not available. The
+            `process_name` is reduced to the executable's name (without the path), the
+            way `nvidia-smi pmon` reports it, so the metrics can be joined.
+
+        Raises
+        ------
+        SmiError
+            Raised in case the command timed out or failed.
+        """
+        stdout = run_smi(smi_query(self.FIELDS, query="compute-apps"))
+        processes = list()
+        for pid, name, uuid, used in parse_smi_output(stdout, self.FIELDS, self.UNITS):
+            try:
+                used_bytes = NvMetric.convert_mb(used)
+            except ValueError:  # e.g. "[N/A]" inside containers
+                used_bytes = None
+            name = path.basename(name.strip())
+            processes.append((pid.strip(), name, uuid.strip(), used_bytes))
+        return processes
+
+    def select(self, processes):
+        """Limit the processes to `max_series`, preferring already reported ones.
+
+        Parameters
+        ----------
+        processes : list(tuple)
+            The processes as returned by `query()`.
+
+        Returns
+        -------
+        list(tuple)
+            The processes to report.
+        """
+        known = self._known
+        processes = sorted(processes, key=lambda x: (x[2], x[0]) not in known)
+        selected = processes[: self.max_series]
+        self.dropped += len(processes) - len(selected)
+        for pid, _, uuid, _ in selected:
+            known.pop((uuid, pid), None)
+            known[(uuid, pid)] = True
+        while len(known) > self.max_series:
+            known.popitem(last=False)
+        return selected
+
+    def add_to(self, metric_collection):
+        """Query the processes and add their metrics to a collection.
+
+        Failures are logged (and counted as errors) but don't affect the collection.
+
+        Parameters
+        ----------
+        metric_collection : PromMetricCollection
+        """
+        try:
+            with STATS.timed("apps"):
+                processes = self.select(self.query())
+        except SmiError as err:
+            LOG.error("Querying compute processes failed: %s", err)
+            STATS.count_error()
+            return
+
+        extra_labels = [""] * len(processes)
+        if self.jobs is not None:
+            with STATS.timed("apps"):
+                extra_labels = [", " + self.jobs.resolve(x[0]) for x in processes]
+                self.jobs.prune(set(x[0] for x in processes))
+
+        name = "nvsmi_process_used_memory_bytes"
+        help_line = "# HELP %s GPU RAM used by the process" % name
+        type_line = "# TYPE %s gauge" % name
+        for (pid, process_name, uuid, used_bytes), extra in zip(
+            processes, extra_labels
+        ):
+            if used_bytes is None:
+                continue
+            labels = self.gpu_labels.get(uuid, 'gpu_uuid="%s"' % uuid)
+            nlv_string = '%s{%s, pid="%s", process_name="%s"%s} %s' % (
+                name,
+                labels,
+                pid,
+                escape_label(process_name),
+                extra,
+                used_bytes,
+            )
+            metric_collection.add_line(name, help_line, type_line, nlv_string)
+
+        name = "nvsmi_exporter_process_series_dropped_total"
+        metric_collection.add_line(
+            name,
+            "# HELP %s process series omitted due to PROCESS_SERIES_MAX" % name,
+            "# TYPE %s counter" % name,
+            "%s %s" % (name, self.dropped),
+        )
+
+
+class DmonCollector(object):
+
+    """Collector for the per-second device statistics of `nvidia-smi dmon`.
+
+    A single `nvidia-smi dmon` child is kept running by a background thread (restarted
+    if it exits or stalls) and its fixed-width rows are parsed as they arrive. The
+    columns are taken from the two header lines `dmon` prints (names and units), so any
+    selection of metric groups works. The samples are aggregated per GPU and column and
+    exported as `nvsmi_dmon_<column><unit_suffix>` with the suffixes `_min`, `_max`,
+    `_avg` and `_last` (like the `Aggregator` does) covering all samples since the last
+    call to `add_to()`. As `dmon` identifies the GPUs by their index only, the index is
+    mapped to the labels of the GPU from the regular queries.
+
+    Attributes
+    ----------
+    cmd : list(str)
+        The complete command line used to start the `nvidia-smi dmon` child.
+    gpu_labels : dict(str)
+        The label string of each GPU, using the GPU's index as the key.
+    """
+
+    COMMAND = "dmon"
+    PREFIX = "nvsmi_dmon_"
+
+    # the Prometheus name suffix and the function converting the value to base units
+    # for the unit strings `dmon` reports (columns with other units are passed through):
+    UNITS = {
+        "W": ("_watts", None),
+        "C": ("_celsius", None),
+        "%": ("_ratio", NvMetric.convert_percent),
+        "MHz": ("_hertz", NvMetric.convert_mhz),
+        "MB": ("_bytes", NvMetric.convert_mb),
+        "MB/s": ("_bytes_per_second", NvMetric.convert_mb),
+    }
+
+    DESCRIPTIONS = {
+        "pwr": "power draw",
+        "gtemp": "GPU temperature",
+        "mtemp": "memory temperature",
+        "sm": "SM utilization",
+        "mem": "memory utilization",
+        "enc": "encoder utilization",
+        "dec": "decoder utilization",
+        "jpg": "JPEG decoder utilization",
+        "ofa": "optical flow accelerator utilization",
+        "mclk": "memory clock",
+        "pclk": "processor clock",
+        "pviol": "power violation time",
+        "tviol": "thermal violation",
+        "fb": "frame buffer memory used",
+        "bar1": "BAR1 memory used",
+        "sbecc": "single bit ECC errors",
+        "dbecc": "double bit ECC errors",
+        "pci": "PCI-E replay errors",
+        "rxpci": "PCI-E receive throughput",
+        "txpci": "PCI-E transmit throughput",
+    }
+
+    def __init__(self, select):
+        """Initialize the collector (the child process is started by `start()`).
+
+        Parameters
+        ----------
+        select : str
+            The metric groups to monitor, passed to `nvidia-smi dmon -s` (e.g. `puct`
+            for power and temperature, utilization, clocks and PCI-E throughput).
+        """
+        self.cmd = ["nvidia-smi", self.COMMAND, "-s", select]
+        self.gpu_labels = dict()
+        self._names = None
+        self._columns = None
+        self._gpu_pos = 0
+        self._samples = dict()
+        self._lock = threading.Lock()
+        self._proc = None
+        self._last_output = monotonic()
+
+    def start(self):
+        """Start the background thread running and reading the `dmon` child."""
+        reader = threading.Thread(target=self._run, name=self.COMMAND)
+        reader.daemon = True
+        reader.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Terminate the child process (if running)."""
+        proc = self._proc
+        if proc is not None and proc.poll() is None:
+            kill_process_group(proc, signal.SIGTERM)
+
+    def _run(self):
+        """Run the `dmon` child and process its output, restarting it if it ends."""
+        restarts = 0
+        while True:
+            LOG.info("call to `nvidia-smi`: <%s>", " ".join(self.cmd))
+            try:
+                self._proc = start_smi(self.cmd, bufsize=1)
+            except OSError as err:
+                LOG.error("Starting `%s` failed: %s", " ".join(self.cmd), err)
+            else:
+                self._last_output = monotonic()
+                for line in iter(self._proc.stdout.readline, ""):
+                    self._last_output = monotonic()
+                    if self.add_line(line):
+                        restarts = 0
+                LOG.warning(
+                    "`%s` ended (exit code %s), restarting...",
+                    " ".join(self.cmd),
+                    self._proc.wait(),
+                )
+            STATS.count_error()
+            restarts += 1
+            time.sleep(min(2**restarts, BACKOFF_MAX))
+
+    def parse_header(self, line):
+        """Process a header line of the `dmon` output (starting with `#`).
+
+        The first header line contains the column names, the second one their units.
+
+        Parameters
+        ----------
+        line : str
+        """
+        fields = line.lstrip("#").split()
+        if "gpu" in fields:
+            self._names = fields
+            self._gpu_pos = fields.index("gpu")
+            return
+        if self._names is None or len(fields) != len(self._names):
+            return
+        columns = list()
+        for name, unit in zip(self._names, fields):
+            suffix, convert = self.UNITS.get(unit, ("", None))
+            metric = self.PREFIX + re.sub("[^a-zA-Z0-9_]", "_", name) + suffix
+            description = self.DESCRIPTIONS.get(name, "`%s` column" % name)
+            columns.append((metric, description, convert))
+        self._columns = columns
+
+    @staticmethod
+    def parse_value(raw, convert):
+        """Process a raw value of the `dmon` output.
+
+        Parameters
+        ----------
+        raw : str
+            The value as reported by `nvidia-smi`, `-` if it's not available.
+        convert : callable or None
+            The conversion function for the column, see `UNITS`.
+
+        Returns
+        -------
+        int or float or None
+            The converted value or `None` if it's not available or not a number.
+        """
+        try:
+            value = int(raw)
+        except ValueError:
+            try:
+                value = float(raw)
+            except ValueError:  # e.g. "-" or "N/A"
+                return None
+        if convert is not None:
+            value = convert(value)
+        return value
+
+    def add_line(self, line):
+        """Process a line of the `dmon` output, adding a row's values to the samples.
+
+        Parameters
+        ----------
+        line : str
+
+        Returns
+        -------
+        bool
+            True if the line was a valid row, False otherwise.
+        """
+        if line.startswith("#"):
+            self.parse_header(line)
+            return False
+        fields = line.split()
+        columns = self._columns
+        if columns is None or len(fields) != len(columns):
+            return False
+        try:
+            index = int(fields[self._gpu_pos])
+        except ValueError:
+            return False
+        with self._lock:
+            for pos, raw in enumerate(fields):
+                name, description, convert = columns[pos]
+                value = self.parse_value(raw, convert)
+                if value is None or pos == self._gpu_pos:
+                    continue
+                state = self._samples.get((name, index))
+                if state is None:
+                    state = [description, 1, value, value, value, value]
+                    self._samples[(name, index)] = state
+                    continue
+                state[1] += 1
+                state[2] += value
+                if value < state[3]:
+                    state[3] = value
+                if value > state[4]:
+                    state[4] = value
+                state[5] = value
+        return True
+
+    def check_stalled(self):
+        """Kill the child if it didn't produce any output for SMI_TIMEOUT seconds.
+
+        The reader thread will then restart it.
+        """
+        proc = self._proc
+        if proc is not None and monotonic() - self._last_output > SMI_TIMEOUT:
+            LOG.error("`%s` stalled, killing it", " ".join(self.cmd))
+            kill_process_group(proc)
+            self._last_output = monotonic()
+
+    def update_labels(self, rows):
+        """Update the GPU labels from the processed values of the GPUs.
+
+        Parameters
+        ----------
+        rows : list(list)
+            The processed values, one row per GPU (ordered like `SCHEMA.names`).
+        """
+        index_pos = SCHEMA.index["index"]
+        for row in rows:
+            self.gpu_labels[row[index_pos]] = SCHEMA.label_string(row)
+
+    def add_to(self, metric_collection):
+        """Add the aggregated samples to a collection and reset them.
+
+        Parameters
+        ----------
+        metric_collection : PromMetricCollection
+        """
+        self.check_stalled()
+        with self._lock:
+            samples = self._samples
+            self._samples = dict()
+
+        add_line = metric_collection.add_line
+        for (name, index), state in sorted(samples.items()):
+            description, count, total, minimum, maximum, last = state
+            labels = self.gpu_labels.get(index, 'index="%s"' % index)
+            values = (minimum, maximum, float(total) / count, last)
+            for (suffix, kind), value in zip(Aggregator.SUFFIXES, values):
+                series = name + suffix
+                add_line(
+                    series,
+                    "# HELP %s %s (%s of samples)" % (series, description, kind),
+                    "# TYPE %s gauge" % series,
+                    "%s{%s} %s" % (series, labels, value),
+                )
+
+
+class PmonCollector(DmonCollector):
+
+    """Collector for the per-process utilization reported by `nvidia-smi pmon`.
+
+    Works like the `DmonCollector` (reusing its handling of the child process and of
+    the header lines), but `pmon` reports one row per process and GPU. The samples are
+    aggregated per GPU and PID and exported as `nvsmi_pmon_<column><unit_suffix>` with
+    the suffixes `_avg` and `_max` covering all samples since the last call to
+    `add_to()`, carrying the labels of the GPU plus `pid` and `process_name` (and
+    optionally the job labels, see `JobResolver`).
+
+    To keep the memory bounded on busy nodes, at most `max_processes` processes are
+    tracked (the samples of additional ones are dropped and counted) and a process is
+    evicted once it hasn't been seen for `evict_after` intervals.
+
+    Attributes
+    ----------
+    max_processes : int
+        The maximum number of processes to track.
+    evict_after : int
+        The number of intervals (calls to `add_to()`) after which a process that hasn't
+        been reported by `pmon` anymore is evicted.
+    jobs : JobResolver or None
+        The resolver for the job labels, `None` to omit them.
+    dropped : int
+        The total number of samples dropped due to the limit.
+    """
+
+    COMMAND = "pmon"
+    PREFIX = "nvsmi_pmon_"
+    SUFFIXES = (("_avg", "average"), ("_max", "maximum"))
+
+    # the columns that are not exported as metrics:
+    KEYS = ("gpu", "pid", "type", "command")
+
+    def __init__(self, select, max_processes, evict_after, jobs=None):
+        """Initialize the collector (the child process is started by `start()`).
+
+        Parameters
+        ----------
+        select : str
+            The metric groups to monitor, passed to `nvidia-smi pmon -s` (e.g. `um` for
+            utilization and frame buffer memory).
+        max_processes : int
+            See the class attributes for details.
+        evict_after : int
+            See the class attributes for details.
+        jobs : JobResolver, optional
+            See the class attributes for details, by default None.
+        """
+        super(PmonCollector, self).__init__(select)
+        self.max_processes = max_processes
+        self.evict_after = evict_after
+        self.jobs = jobs
+        self.dropped = 0
+        self._pid_pos = None
+        self._value_pos = ()
+        self._processes = dict()
+
+    def parse_header(self, line):
+        """Process a header line of the `pmon` output (starting with `#`).
+
+        Parameters
+        ----------
+        line : str
+        """
+        super(PmonCollector, self).parse_header(line)
+        names = self._names
+        if self._columns is None or "pid" not in names or names[-1] != "command":
+            self._columns = None
+            return
+        self._pid_pos = names.index("pid")
+        self._value_pos = tuple(
+            i for i, name in enumerate(names) if name not in self.KEYS
+        )
+
+    def add_line(self, line):
+        """Process a line of the `pmon` output, adding a row's values to the samples.
+
+        Parameters
+        ----------
+        line : str
+
+        Returns
+        -------
+        bool
+            True if the line was a valid row, False otherwise.
+        """
+        if line.startswith("#"):
+            self.parse_header(line)
+            return False
+        fields = line.split()
+        columns = self._columns
+        if columns is None or len(fields) < len(columns):
+            return False
+        pid = fields[self._pid_pos]
+        if not pid.isdigit():  # "-" for a GPU without any processes
+            return True
+        try:
+            key = (int(fields[self._gpu_pos]), pid)
+        except ValueError:
+            return False
+
+        with self._lock:
+            state = self._processes.get(key)
+            if state is None:
+                if len(self._processes) >= self.max_processes:
+                    self.dropped += 1
+                    return True
+                state = [None, 0, dict()]
+                self._processes[key] = state
+            # the command is the last column and may contain spaces:
+            state[0] = " ".join(fields[len(columns) - 1 :])
+            state[1] = 0
+            samples = state[2]
+            for pos in self._value_pos:
+                value = self.parse_value(fields[pos], columns[pos][2])
+                if value is None:
+                    continue
+                sample = samples.get(pos)
+                if sample is None:
+                    samples[pos] = [1, value, value]
+                    continue
+                sample[0] += 1
+                sample[1] += value
+                if value > sample[2]:
+                    sample[2] = value
+        return True
+
+    def add_to(self, metric_collection):
+        """Add the aggregated samples to a collection, reset them and evict processes.
+
+        Parameters
+        ----------
+        metric_collection : PromMetricCollection
+        """
+        self.check_stalled()
+        reported = list()
+        with self._lock:
+            for key, state in list(self._processes.items()):
+                if state[2]:
+                    reported.append((key, state[0], state[2]))
+                    state[2] = dict()
+                # the number of intervals the process has not been seen in (plus one):
+                state[1] += 1
+                if state[1] > self.evict_after:
+                    del self._processes[key]
+            tracked = len(self._processes)
+
+        add_line = metric_collection.add_line
+        columns = self._columns
+        for (index, pid), command, samples in sorted(reported):
+            labels = '%s, pid="%s", process_name="%s"' % (
+                self.gpu_labels.get(index, 'index="%s"' % index),
+                pid,
+                escape_label(command),
+            )
+            if self.jobs is not None:
+                labels += ", " + self.jobs.resolve(pid)
+            for pos, (count, total, maximum) in sorted(samples.items()):
+                name, description, _ = columns[pos]
+                values = (float(total) / count, maximum)
+                for (suffix, kind), value in zip(self.SUFFIXES, values):
+                    series = name + suffix
+                    add_line(
+                        series,
+                        "# HELP %s %s (%s of samples)" % (series, description, kind),
+                        "# TYPE %s gauge" % series,
+                        "%s{%s} %s" % (series, labels, value),
+                    )
+        if self.jobs is not None:
+            self.jobs.prune(set(pid for (_, pid), _, _ in reported))
+
+        for name, description, value, metric_type in (
+            ("pmon_processes", "processes tracked from `pmon`", tracked, "gauge"),
+            (
+                "pmon_samples_dropped_total",
+                "`pmon` samples dropped due to PROCESS_SERIES_MAX",
+                self.dropped,
+                "counter",
+            ),
+        ):
+            name = "nvsmi_exporter_" + name
+            metric_collection.add_line(
+                name,
+                "# HELP %s %s" % (name, description),
+                "# TYPE %s %s" % (name, metric_type),
+                "%s %s" % (name, value),
+            )
+
+
+def process_gpu_metrics(values_from_csv, metric_collection):
+    """Process one line of (parsed) CSV output from an `nvidia-smi` query.
+
+    Parameters
+    ----------
+    values_from_csv : list(str)
+        A single line of the parsed CSV (including unit strings), obtained e.g. by a
+        `csv.reader()` call.
+    metric_collection : PromMetricCollection
+        The collection object where processed metrics should be added to.
+    """
+    LOG.debug("values_from_csv: %s", values_from_csv)
+    row = [x.parse(val) for x, val in zip(SCHEMA.metrics, values_from_csv)]
+    SCHEMA.add_row(row, metric_collection)
+
+
+# the list of properties to query for using "nvidia-smi":
+METRICS = [
+    NvMetric("driver_version", "NVIDIA display driver version", "str", static=True),
+    NvMetric(
+        "gpu_serial",
+        "the serial number physically printed on the board",
+        "str",
+        static=True,
+    ),
+    NvMetric(
+        "gpu_uuid",
+        "globally unique immutable alphanumeric identifier",
+        "str",
+        static=True,
+    ),
+    NvMetric("gpu_name", "official product name of the GPU", "str", static=True),
+    NvMetric(
+        "index",
+        "zero-based index of the GPU, can change at each boot",
+        "int",
+        static=True,
+    ),
+    NvMetric("utilization.gpu", "percent of time the GPU was busy", "pct"),
+    NvMetric("utilization.memory", "percent of time GPU RAM was read / written", "pct"),
+    NvMetric("memory.total", "total installed GPU RAM", "mb", static=True),
+    NvMetric("memory.free", "total free GPU RAM", "mb"),
+    NvMetric("memory.used", "total GPU RAM used by active contexts", "mb"),
+    NvMetric("temperature.gpu", "core GPU temperature in degrees C", "degc"),
+    NvMetric("fan.speed", "intended (NOT MEASURED!) fan speed in percent", "pct"),
+    NvMetric("power.draw", "power draw for the entire board in Watts", "watt"),
+    NvMetric("power.limit", "software power limit in Watts", "watt", static=True),
+    NvMetric("pci.domain", "PCI domain number", "hex", static=True, digits=4),
+    NvMetric("pci.bus", "PCI bus number", "hex", static=True, digits=2),
+    NvMetric("pci.device", "PCI device number", "hex", static=True, digits=2),
+    NvMetric("pci.device_id", "PCI vendor device id", "hex", static=True, digits=8),
+    NvMetric(
+        "clocks_throttle_reasons.active",
+        "bitmask of the reasons the clocks are currently throttled",
+        "bitmask",
+    ),
+    NvMetric(
+        "pcie.link.gen.current",
+        "current PCI-E link generation in use with this GPU and system",
+        "int",
+    ),
+    NvMetric(
+        "pcie.link.gen.max",
+        "maximum PCI-E link generation possible with this GPU and system",
+        "int",
+        static=True,
+    ),
+    NvMetric(
+        "pcie.link.width.current",
+        "current PCI-E link width in use with this GPU and system",
+        "int",
+    ),
+    NvMetric(
+        "pcie.link.width.max",
+        "maximum PCI-E link width possible with this GPU and system configuration",
+        "int",
+        static=True,
+    ),
+]
+
+# a list of PROPERTIES that should be used as labels for all Prometheus metrics:
+USE_AS_LABEL = [
+    "gpu_serial",
+    "gpu_name",
+    "gpu_uuid",
+    "index",
+    "pci.domain",
+    "pci.bus",
+    "pci.device",
+    "pci.device_id",
+]
+
+# compile the metric definitions once:
+SCHEMA = MetricSchema(METRICS, USE_AS_LABEL)
+
+STATS = ExporterStats()
+
+# the objects depending on the configuration are only created by `setup()`, so nothing
+# is loaded (e.g. cache files) that a single run wouldn't need:
+HEALTH = None
+FIELDS = None
+PROBER = None
+ENERGY = None
+THROTTLE = None
+PROCS = None
+MONITORS = list()
+WRITER = None
+
+
+def setup(metrics=METRICS, once=False):
+    """Create the schema and all objects required by the configuration.
+
+    Parameters
+    ----------
+    metrics : list(NvMetric), optional
+        The metric definitions to use, by default `METRICS`.
+    once : bool, optional
+        Set up for a single run (`--once`), by default False.
+    """
+    # pylint: disable-msg=global-statement
+    global SCHEMA, HEALTH, FIELDS, PROBER, ENERGY, THROTTLE, PROCS, MONITORS, WRITER
+    if metrics is not METRICS:
+        SCHEMA = MetricSchema(metrics, USE_AS_LABEL)
+    HEALTH = CollectionHealth(
+        max(BACKOFF_MAX // max(SLEEP_TIME, 1), 1), BREAKER_THRESHOLD
+    )
+    # a single run gains nothing from querying static properties separately or from
+    # probing, both would need additional calls to `nvidia-smi`:
+    FIELDS = StaticFieldCache(SCHEMA, 0 if once else STATIC_REFRESH)
+    if PROBE and not once:
+        PROBER = CapabilityProbe(SCHEMA, PROBE_CACHE)
+    if COUNTERS:
+        ENERGY = IntegratedCounters(SCHEMA, max(3 * SLEEP_TIME, 1), STATE_FILE)
+    if ThrottleReasons.PROPERTY in SCHEMA.index:
+        # a single run has only one sample, so there is nothing to integrate:
+        THROTTLE = ThrottleReasons(SCHEMA, max(3 * SLEEP_TIME, 1), counter=not once)
+
+    jobs = JobResolver(PROC_ROOT) if JOB_LABELS else None
+    if PROCESSES:
+        PROCS = ProcessCollector(PROCESS_SERIES_MAX, jobs)
+    # the monitors need a persistent child process, which a single run can't have:
+    MONITORS = list()
+    if DMON and not once:
+        MONITORS.append(DmonCollector(DMON))
+    if PMON and not once:
+        MONITORS.append(PmonCollector(PMON, PROCESS_SERIES_MAX, PMON_EVICT, jobs))
+
+    if TEXTFILE_DIR:
+        WRITER = TextfileWriter(path.join(TEXTFILE_DIR, "nvsmi.prom"), FSYNC)
+
+
+class SmiStream(object):
+
+    """A persistent `nvidia-smi --loop-ms` child process delivering CSV batches.
+
+    Instead of forking a new `nvidia-smi` for every collection run (paying the driver
+    initialization cost each time) a single long-lived child is started that prints
+    one CSV row per GPU every `loop_ms` milliseconds. Its output is read line by line
+    and split into per-cycle batches. If the child dies it is restarted transparently.
+
+    Attributes
+    ----------
+    query : list(str)
+        The names of the queried properties, the rows of each batch are in this order.
+    cmd : list(str)
+        The complete command line used to start the `nvidia-smi` child.
+    key_pos : int
+        The position of a column uniquely identifying a GPU (e.g. the UUID) in the CSV
+        rows, used to detect the beginning of a new cycle.
+    gpu_count : int
+        The number of GPUs expected per batch, determined on every (re-)start.
+    """
+
+    def __init__(self, query, loop_ms, key_pos):
+        """Initialize the stream object (the child process is started lazily).
+
+        Parameters
+        ----------
+        query : list(str)
+            The names of the properties to query for.
+        loop_ms : int
+            The sampling interval in milliseconds passed to `nvidia-smi --loop-ms`.
+        key_pos : int
+            See the class attributes for details.
+        """
+        self.query = query
+        self.cmd = smi_query(query, "csv,noheader,nounits") + ["--loop-ms=%d" % loop_ms]
+        self.key_pos = key_pos
+        self.loop_ms = loop_ms
+        self.gpu_count = 0
+        self._positions = None
+        self._proc = None
+        self._last_output = 0
+
+    def start(self):
+        """Determine the number of GPUs and columns and start the streaming child.
+
+        As the streamed output has no header, a single query (including the header) is
+        run first to learn the column order and the number of GPUs.
+
+        Raises
+        ------
+        SmiError
+            Raised in case the initial query fails or its header doesn't match.
+        """
+        stdout = run_smi(smi_query(self.query))
+        header = stdout.split("\n", 1)[0]
+        self._positions = column_positions(header, self.query)
+        self.gpu_count = len(parse_smi_output(stdout))
+        LOG.info("Starting `nvidia-smi` stream for %s GPUs", self.gpu_count)
+        LOG.info("call to `nvidia-smi`: <%s>", " ".join(self.cmd))
+        self._proc = start_smi(self.cmd, bufsize=1)
+        self._last_output = monotonic()
+        watchdog = threading.Thread(target=self._watch, args=(self._proc,))
+        watchdog.daemon = True
+        watchdog.start()
+
+    def _watch(self, proc):
+        """Kill the child if it doesn't produce any output for too long.
+
+        Parameters
+        ----------
+        proc : subprocess.Popen
+            The child process to watch, the method returns once it has terminated.
+        """
+        timeout = SMI_TIMEOUT + self.loop_ms / 1000.0
+        while proc.poll() is None:
+            time.sleep(min(timeout / 2, 1))
+            if monotonic() - self._last_output > timeout:
+                LOG.error("`nvidia-smi` stream stalled, killing it")
+                kill_process_group(proc)
+                return
+
+    def stop(self):
+        """Terminate the child process (if running)."""
+        if self._proc is None:
+            return
+        if self._proc.poll() is None:
+            kill_process_group(self._proc, signal.SIGTERM)
+        self._proc.wait()
+        self._proc = None
+
+    def batches(self):
+        """Generator yielding the parsed CSV rows of one sampling cycle at a time.
+
+        A batch is considered complete once `gpu_count` rows have been read, or if a
+        GPU shows up a second time (e.g. in case a GPU has disappeared since the
+        count was determined). The child process is restarted if its output ends (e.g.
+        after being killed due to not producing any output for SMI_TIMEOUT seconds),
+        with an exponential backoff in case of repeated failures.
+
+        Yields
+        ------
+        list(list(str))
+            The parsed CSV rows of one cycle, one row per GPU.
+        """
+        restarts = 0
+        while True:
+            if self._proc is None:
+                try:
+                    self.start()
+                except (SmiError, OSError) as err:
+                    LOG.error("Starting `nvidia-smi` stream failed: %s", err)
+                    STATS.count_error()
+                    HEALTH.failure()
+                    restarts += 1
+                    time.sleep(min(2**restarts, BACKOFF_MAX))
+                    continue
+            batch = list()
+            seen = set()
+            for line in iter(self._proc.stdout.readline, ""):
+                self._last_output = monotonic()
+                line = line.rstrip("\n")
+                if not line:
+                    continue
+                row = split_csv_line(line)
+                if self._positions is not None:
+                    row = [row[i] for i in self._positions]
+                key = row[self.key_pos].strip()
+                if key in seen:
+                    HEALTH.success()
+                    yield batch
+                    batch = list()
+                    seen = set()
+                batch.append(row)
+                seen.add(key)
+                if len(batch) >= self.gpu_count:
+                    restarts = 0
+                    HEALTH.success()
+                    yield batch
+                    batch = list()
+                    seen = set()
+
+            LOG.warning(
+                "`nvidia-smi` stream ended (exit code %s), restarting...",
+                self._proc.wait(),
+            )
+            self._proc = None
+            STATS.count_error()
+            HEALTH.failure()
+            restarts += 1
+            time.sleep(min(2**restarts, BACKOFF_MAX))
+
+
+NVML_SUCCESS = 0
+NVML_ERROR_NOT_SUPPORTED = 3
+NVML_TEMPERATURE_GPU = 0
+
+
+class NvmlError(Exception):
+
+    """Raised when a call to the NVML library fails."""
+
+
+def nvml_structures(ctypes):
+    """Define the structures filled in by the NVML library.
+
+    They're only defined when the `nvml` backend is used, so `ctypes` doesn't have to
+    be imported otherwise (e.g. for `--once`).
+
+    Parameters
+    ----------
+    ctypes : module
+        The `ctypes` module.
+
+    Returns
+    -------
+    (type, type, type)
+        The structures for the utilization rates, the memory info and the PCI info.
+    """
+    # pylint: disable-msg=too-few-public-methods
+
+    class NvmlUtilization(ctypes.Structure):
+        _fields_ = [("gpu", ctypes.c_uint), ("memory", ctypes.c_uint)]
+
+    class NvmlMemory(ctypes.Structure):
+        _fields_ = [
+            ("total", ctypes.c_ulonglong),
+            ("free", ctypes.c_ulonglong),
+            ("used", ctypes.c_ulonglong),
+        ]
+
+    class NvmlPciInfo(ctypes.Structure):
+        _fields_ = [
+            ("busIdLegacy", ctypes.c_char * 16),
+            ("domain", ctypes.c_uint),
+            ("bus", ctypes.c_uint),
+            ("device", ctypes.c_uint),
+            ("pciDeviceId", ctypes.c_uint),
+            ("pciSubSystemId", ctypes.c_uint),
+            ("busId", ctypes.c_char * 32),
+        ]
+
+    return NvmlUtilization, NvmlMemory, NvmlPciInfo
+
+
+class NvmlBackend(object):
+
+    """Collector backend querying `libnvidia-ml.so` directly through `ctypes`.
+
+    This avoids forking `nvidia-smi` and parsing its text output entirely, the values
+    are requested from the NVML library and returned already converted to the units
+    used in the Prometheus output, ready to be processed by the `MetricSchema`.
+
+    Attributes
+    ----------
+    lib : ctypes.CDLL
+        The NVML library handle. Any object providing the `nvml*` functions used here
+        can be passed to the constructor instead, e.g. a stub library or a mock when
+        testing on machines without a GPU.
+    """
+
+    def __init__(self, lib=None):
+        """Load (unless given) and initialize the NVML library.
+
+        Parameters
+        ----------
+        lib : object, optional
+            See the class attributes for details. If omitted the library specified
+            in `NVML_LIBRARY` will be loaded.
+
+        Raises
+        ------
+        NvmlError
+            Raised in case initializing NVML fails.
+        """
+        import ctypes  # pylint: disable-msg=import-outside-toplevel
+
+        self._ctypes = ctypes
+        self._structures = nvml_structures(ctypes)
+        if lib is None:
+            lib = ctypes.CDLL(NVML_LIBRARY)
+        self.lib = lib
+        self._check("nvmlInit_v2")
+
+    def shutdown(self):
+        """Release the resources allocated by NVML."""
+        self._check("nvmlShutdown")
+
+    def _call(self, func_name, *args):
+        """Call an NVML function, returning `True` on success.
+
+        An unsupported query returns `False` silently, any other error is logged and
+        also results in `False` (so only the affected values are disabled).
+        """
+        ret = getattr(self.lib, func_name)(*args)
+        if ret == NVML_SUCCESS:
+            return True
+        if ret != NVML_ERROR_NOT_SUPPORTED:
+            LOG.warning("NVML call '%s' failed with code %s", func_name, ret)
+        return False
+
+    def _check(self, func_name, *args):
+        """Call an NVML function, raising an `NvmlError` if it doesn't succeed."""
+        ret = getattr(self.lib, func_name)(*args)
+        if ret != NVML_SUCCESS:
+            raise NvmlError("NVML call '%s' failed with code %s" % (func_name, ret))
+
+    def _string(self, func_name, *args):
+        """Query a string value from NVML, returns `None` in case of failure."""
+        ctypes = self._ctypes
+        buf = ctypes.create_string_buffer(96)
+        if not self._call(func_name, *(args + (buf, ctypes.c_uint(96)))):
+            return None
+        value = buf.value
+        if not isinstance(value, str):
+            value = value.decode("utf-8", "replace")
+        return value
+
+    def _uint(self, func_name, *args):
+        """Query an unsigned int value from NVML, returns `None` in case of failure."""
+        ctypes = self._ctypes
+        value = ctypes.c_uint()
+        if not self._call(func_name, *(args + (ctypes.byref(value),))):
+            return None
+        return value.value
+
+    def _device_values(self, handle):
+        """Query all values of a single device.
+
+        Parameters
+        ----------
+        handle : ctypes.c_void_p
+            The NVML device handle.
+
+        Returns
+        -------
+        dict
+            The values (in Prometheus units) using the `nvidia-smi` property names as
+            keys. Unsupported properties are missing from the dict.
+        """
+        ctypes = self._ctypes
+        utilization_type, memory_type, pci_info_type = self._structures
+        values = dict()
+        values["gpu_serial"] = self._string("nvmlDeviceGetSerial", handle)
+        values["gpu_uuid"] = self._string("nvmlDeviceGetUUID", handle)
+        values["gpu_name"] = self._string("nvmlDeviceGetName", handle)
+        values["index"] = self._uint("nvmlDeviceGetIndex", handle)
+
+        util = utilization_type()
+        if self._call("nvmlDeviceGetUtilizationRates", handle, ctypes.byref(util)):
+            values["utilization.gpu"] = util.gpu / 100.0
+            values["utilization.memory"] = util.memory / 100.0
+
+        memory = memory_type()
+        if self._call("nvmlDeviceGetMemoryInfo", handle, ctypes.byref(memory)):
+            values["memory.total"] = memory.total
+            values["memory.free"] = memory.free
+            values["memory.used"] = memory.used
+
+        values["temperature.gpu"] = self._uint(
+            "nvmlDeviceGetTemperature", handle, NVML_TEMPERATURE_GPU
+        )
+        fan_speed = self._uint("nvmlDeviceGetFanSpeed", handle)
+        if fan_speed is not None:
+            values["fan.speed"] = fan_speed / 100.0
+        # power values are reported in milliwatts:
+        for name, func_name in (
+            ("power.draw", "nvmlDeviceGetPowerUsage"),
+            ("power.limit", "nvmlDeviceGetPowerManagementLimit"),
+        ):
+            milliwatts = self._uint(func_name, handle)
+            if milliwatts is not None:
+                values[name] = milliwatts / 1000.0
+
+        pci = pci_info_type()
+        if self._call("nvmlDeviceGetPciInfo_v3", handle, ctypes.byref(pci)):
+            values["pci.domain"] = pci.domain
+            values["pci.bus"] = pci.bus
+            values["pci.device"] = pci.device
+            values["pci.device_id"] = pci.pciDeviceId
+
+        reasons = ctypes.c_ulonglong()
+        if self._call(
+            "nvmlDeviceGetCurrentClocksThrottleReasons", handle, ctypes.byref(reasons)
+        ):
+            values["clocks_throttle_reasons.active"] = reasons.value
+
+        values["pcie.link.gen.current"] = self._uint(
+            "nvmlDeviceGetCurrPcieLinkGeneration", handle
+        )
+        values["pcie.link.gen.max"] = self._uint(
+            "nvmlDeviceGetMaxPcieLinkGeneration", handle
+        )
+        values["pcie.link.width.current"] = self._uint(
+            "nvmlDeviceGetCurrPcieLinkWidth", handle
+        )
+        values["pcie.link.width.max"] = self._uint(
+            "nvmlDeviceGetMaxPcieLinkWidth", handle
+        )
+        return values
+
+    def collect(self):
+        """Query all GPUs and return their processed values.
+
+        Returns
+        -------
+        list(list)
+            One row per GPU with the values ordered like `SCHEMA.names`, `None` for
+            unsupported ones (same as `MetricSchema.parse_row()` would return).
+        """
+        ctypes = self._ctypes
+        count = ctypes.c_uint()
+        self._check("nvmlDeviceGetCount_v2", ctypes.byref(count))
+        driver_version = self._string("nvmlSystemGetDriverVersion")
+
+        gpus = list()
+        for i in range(count.value):
+            handle = ctypes.c_void_p()
+            self._check("nvmlDeviceGetHandleByIndex_v2", i, ctypes.byref(handle))
+            values = self._device_values(handle)
+            values["driver_version"] = driver_version
+            gpus.append([values.get(name) for name in SCHEMA.names])
+
+        return gpus
+
+
+class MetricCatalog(object):
+
+    """Catalog of all properties `nvidia-smi --query-gpu` supports.
+
+    The property names and descriptions are parsed from `nvidia-smi --help-query-gpu`,
+    the value type of each property is inferred from the unit in the CSV header (e.g.
+    `[MiB]`) or from the values reported by a single query for all properties. As this
+    only depends on the driver, the catalog is cached per driver version (in memory
+    and optionally in a file).
+
+    Attributes
+    ----------
+    entries : dict(tuple)
+        A `(description, value_type)` tuple for each property, using the property name
+        as the key.
+    """
+
+    # the value types for the units reported by `nvidia-smi`:
+    UNIT_TYPES = {"%": "pct", "MiB": "mb", "W": "watt", "MHz": "mhz"}
+
+    # properties not suitable as metrics (e.g. a new label value on every query):
+    EXCLUDED = ("timestamp",)
+
+    def __init__(self, cache_file=""):
+        """Initialize the catalog (entries are loaded through `load()`).
+
+        Parameters
+        ----------
+        cache_file : str, optional
+            The file to cache the catalog in, by default "" (no file).
+        """
+        self.entries = dict()
+        self._cache_file = cache_file
+
+    @staticmethod
+    def parse_help(text):
+        """Parse the output of `nvidia-smi --help-query-gpu`.
+
+        Each property is listed as its quoted name (possibly followed by alternative
+        names, e.g. `"clocks.current.sm" or "clocks.sm"`) on a separate line, followed
+        by its description.
+
+        Parameters
+        ----------
+        text : str
+
+        Returns
+        -------
+        list(tuple)
+            A `(name, description)` tuple for each property (using the first name,
+        mapped through `CsvHeader.ALIASES`).
+        """
+        properties = list()
+        lines = text.split("\n")
+        for i, line in enumerate(lines):
+            if not line.startswith('"'):
+                continue
+            name = line.split('"')[1]
+            name = CsvHeader.ALIASES.get(name, name)
+            description = lines[i + 1].strip() if i + 1 < len(lines) else ""
+            properties.append((name, description.replace("\\", "\\\\")))
+        return properties
+
+    @classmethod
+    def infer_type(cls, unit, raw_values):
+        """Infer the value type of a property.
+
+        Parameters
+        ----------
+        unit : str or None
+            The unit from the CSV header.
+        raw_values : list(str)
+            The values reported for the property (one per GPU, without unit).
+
+        Returns
+        -------
+        str
+            The value type as used by `NvMetric`.
+        """
+        if unit in cls.UNIT_TYPES:
+            return cls.UNIT_TYPES[unit]
+        values = [x.strip() for x in raw_values]
+        values = [x for x in values if x and not x.startswith("[") and x != "N/A"]
+        if not values:
+            return "float"  # nothing to infer from, e.g. not supported by the GPUs
+        for value_type in (int, float):
+            try:
+                for value in values:
+                    value_type(value)
+                return value_type.__name__
+            except ValueError:
+                pass
+        if all(x.startswith("0x") for x in values):
+            return "hex"
+        return "str"
+
+    def build(self):
+        """Build the catalog by querying `nvidia-smi`.
+
+        Raises
+        ------
+        SmiError
+            Raised in case `nvidia-smi` couldn't be started or a query timed out or
+            failed.
+        """
+        properties = self.parse_help(run_smi(["nvidia-smi", "--help-query-gpu"]))
+        properties = [x for x in properties if x[0] not in self.EXCLUDED]
+        names = [x[0] for x in properties]
+        stdout = run_smi(smi_query(names))
+        header = CsvHeader(stdout.split("\n", 1)[0])
+        rows = parse_smi_output(stdout)
+        self.entries = dict()
+        for i, (name, description) in enumerate(properties):
+            value_type = self.infer_type(header.units[i], [x[i] for x in rows])
+            self.entries[name] = (description, value_type)
+        LOG.info("Built catalog of %s properties", len(self.entries))
+
+    def load(self):
+        """Load the catalog for the installed driver, building it if necessary.
+
+        Raises
+        ------
+        SmiError
+            Raised in case `nvidia-smi` couldn't be started or a query timed out or
+            failed.
+        """
+        import json  # pylint: disable-msg=import-outside-toplevel
+
+        driver = run_smi(smi_query(["driver_version"], "csv,noheader")).strip()
+        driver = driver.split("\n")[0]
+        cache = dict()
+        if self._cache_file:
+            try:
+                with open(self._cache_file) as cachefile:
+                    cache = json.load(cachefile)
+            except (IOError, OSError, ValueError) as err:
+                LOG.info("Not loading catalog from [%s]: %s", self._cache_file, err)
+        if driver in cache:
+            self.entries = dict((x, tuple(y)) for x, y in cache[driver].items())
+            return
+
+        self.build()
+        if self._cache_file:
+            cache[driver] = self.entries
+            try:
+                TextfileWriter(self._cache_file).write([json.dumps(cache)])
+            except (IOError, OSError) as err:
+                LOG.error("Caching the catalog failed: %s", err)
+
+    def select(self, patterns, exclude=()):
+        """Create the metric definitions for all properties matching the patterns.
+
+        Parameters
+        ----------
+        patterns : list(str)
+            Property names or glob patterns, e.g. `clocks.current.*`.
+        exclude : list(str), optional
+            Names of properties to skip (e.g. because they're defined already).
+
+        Returns
+        -------
+        list(NvMetric)
+        """
+        import fnmatch  # pylint: disable-msg=import-outside-toplevel
+
+        metrics = list()
+        for pattern in patterns:
+            names = sorted(fnmatch.filter(self.entries, pattern.strip()))
+            if not names:
+                LOG.warning("No property matching '%s' found", pattern)
+            for name in names:
+                if name in exclude or name in [x.name for x in metrics]:
+                    continue
+                description, value_type = self.entries[name]
+                metrics.append(NvMetric(name, description, value_type))
+        return metrics
+
+
+def extra_metrics(patterns):
+    """Get the metric definitions for additional properties from the catalog.
+
+    Parameters
+    ----------
+    patterns : str
+        A comma separated list of property names or glob patterns.
+
+    Returns
+    -------
+    list(NvMetric)
+        The definitions of the matching properties not in `METRICS`, empty in case the
+        catalog couldn't be loaded (e.g. `nvidia-smi` is missing).
+    """
+    catalog = MetricCatalog(CATALOG_CACHE)
+    try:
+        catalog.load()
+    except SmiError as err:
+        LOG.error("Loading the catalog of properties failed: %s", err)
+        STATS.count_error()
+        return list()
+    metrics = catalog.select(patterns.split(","), [x.name for x in METRICS])
+    LOG.info("Adding properties: %s", ",".join([x.name for x in metrics]))
+    return metrics
+
+
+class CsvHeader(object):
+
+    """Column names and units parsed from the CSV header line of `nvidia-smi`.
+
+    Attributes
+    ----------
+    names : list(str)
+        The property names of the columns (header aliases like `serial` are mapped
+        back to the names used for querying, e.g. `gpu_serial`).
+    units : list(str or None)
+        The unit of each column (e.g. `MiB` for `memory.total [MiB]`), if any.
+    """
+
+    # names shown in the header that differ from the names used for querying:
+    ALIASES = {
+        "serial": "gpu_serial",
+        "uuid": "gpu_uuid",
+        "name": "gpu_name",
+        "used_gpu_memory": "used_memory",
+        # renamed in newer drivers, which still accept the old name for querying:
+        "clocks_event_reasons.active": "clocks_throttle_reasons.active",
+    }
+
+    def __init__(self, line):
+        """Parse the header line.
+
+        Parameters
+        ----------
+        line : str
+            The header line, e.g. `index, memory.total [MiB], power.draw [W]`.
+        """
+        self.names = list()
+        self.units = list()
+        for column in line.split(","):
+            column = column.strip()
+            unit = None
+            if column.endswith("]") and " [" in column:
+                column, unit = column[:-1].split(" [", 1)
+            self.names.append(self.ALIASES.get(column, column))
+            self.units.append(unit)
+
+    def positions(self, names, units):
+        """Map the requested properties to their column positions.
+
+        Parameters
+        ----------
+        names : list(str)
+            The requested property names.
+        units : dict
+            The expected unit of each property (`None` for unit-less ones).
+
+        Returns
+        -------
+        list(int) or None
+            The column position of each requested property, `None` if the columns
+            are in the requested order already.
+
+        Raises
+        ------
+        SmiError
+            Raised in case a property is missing or reported with an unexpected unit.
+        """
+        positions = list()
+        for name in names:
+            if name not in self.names:
+                raise SmiError("Column '%s' missing in `nvidia-smi` output" % name)
+            pos = self.names.index(name)
+            expected = units.get(name)
+            if expected is not None and self.units[pos] != expected:
+                raise SmiError(
+                    "Unexpected unit for '%s': [%s] instead of [%s]"
+                    % (name, self.units[pos], expected)
+                )
+            positions.append(pos)
+        if positions == list(range(len(self.names))):
+            return None
+        LOG.warning("Columns reported by `nvidia-smi` are reordered: %s", positions)
+        return positions
+
+
+# the column mappings for already seen header lines:
+COLUMN_MAPS = dict()
+
+
+def column_positions(header_line, names, units=None):
+    """Get the column mapping for a header line, parsing it only if it's unknown.
+
+    Parameters
+    ----------
+    header_line : str
+        The CSV header line printed by `nvidia-smi`.
+    names : list(str)
+        The requested property names.
+    units : dict, optional
+        The expected unit of each property, by default `SCHEMA.units`.
+
+    Returns
+    -------
+    list(int) or None
+        See `CsvHeader.positions()` for details.
+    """
+    key = (header_line, tuple(names))
+    if key not in COLUMN_MAPS:
+        LOG.debug("header line:\n----\n%s\n----\n", header_line)
+        if units is None:
+            units = SCHEMA.units
+        COLUMN_MAPS[key] = CsvHeader(header_line).positions(names, units)
+    return COLUMN_MAPS[key]
+
+
+def split_csv_line(line):
+    """Split a CSV line printed by `nvidia-smi` into its values.
+
+    `nvidia-smi` separates the values by ", " and only quotes them if necessary, so
+    unless the line contains a quote character a plain `split()` is sufficient (and
+    a lot faster than the `csv` module, which is used otherwise).
+
+    Parameters
+    ----------
+    line : str
+
+    Returns
+    -------
+    list(str)
+    """
+    if '"' not in line:
+        return line.split(", ")
+    import csv  # pylint: disable-msg=import-outside-toplevel
+
+    return next(csv.reader([line], delimiter=",", skipinitialspace=True), [])
+
+
+def parse_smi_output(stdout, names=None, units=None):
+    """Parse the CSV output of an `nvidia-smi --query-*` call (including header).
+
+    Parameters
+    ----------
+    stdout : str
+        The complete output of the `nvidia-smi` call.
+    names : list(str), optional
+        The requested property names. If given, the header is validated against them
+        and the values are returned in this order, even if `nvidia-smi` reported the
+        columns in a different order.
+    units : dict, optional
+        The expected unit of each property, by default `SCHEMA.units`.
+
+    Returns
+    -------
+    list(list(str))
+        The parsed CSV rows (header and empty lines removed), one row per GPU.
+    """
+    lines = stdout.split("\n")
+    LOG.debug("result from `nvidia-smi`:\n----\n%s\n----\n", lines)
+
+    header = lines.pop(0)
+    # skip lines whose length is zero:
+    rows = [split_csv_line(x) for x in lines if x]
+    if names is None:
+        return rows
+
+    positions = column_positions(header, names, units)
+    if positions is None:
+        return rows
+    return [[row[i] for i in positions] for row in rows]
+
+
+def smi_query(names, output_format="csv,nounits", query="gpu"):
+    """Assemble an `nvidia-smi --query-gpu` command.
+
+    Parameters
+    ----------
+    names : list(str)
+        The properties to query for.
+    output_format : str, optional
+        The value for the `--format` option, by default "csv,nounits".
+    query : str, optional
+        The kind of query, e.g. "compute-apps" for `--query-compute-apps`, by default
+        "gpu".
+
+    Returns
+    -------
+    list(str)
+    """
+    return [
+        "nvidia-smi",
+        "--query-%s=%s" % (query, ",".join(names)),
+        "--format=%s" % output_format,
+    ]
+
+
+class SmiError(Exception):
+
+    """Raised when a call to `nvidia-smi` fails or times out."""
+
+
+def kill_process_group(proc, sig=signal.SIGKILL):
+    """Send a signal to the process group of a child started by `start_smi()`.
+
+    Parameters
+    ----------
+    proc : subprocess.Popen
+    sig : int, optional
+        The signal to send, by default `SIGKILL`.
+    """
+    try:
+        os.killpg(proc.pid, sig)
+    except OSError:  # the process has terminated already
+        pass
+
+
+def start_smi(cmd, **kwargs):
+    """Start `nvidia-smi` in a new process group, so it can be killed as a whole.
+
+    Parameters
+    ----------
+    cmd : list(str)
+        The command to run.
+    **kwargs
+        Additional arguments passed on to `subprocess.Popen`.
+
+    Returns
+    -------
+    subprocess.Popen
+    """
+    return subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        preexec_fn=os.setsid,
+        **kwargs
+    )
+
+
+def run_smi(cmd):
+    """Run `nvidia-smi` and return its output, killing it after SMI_TIMEOUT seconds.
+
+    Parameters
+    ----------
+    cmd : list(str)
+        The command to run.
+
+    Returns
+    -------
+    str
+        The output of the command.
+
+    Raises
+    ------
+    SmiError
+        Raised in case the command couldn't be started (e.g. `nvidia-smi` is missing),
+        timed out or returned a non-zero exit code.
+    """
+    try:
+        proc = start_smi(cmd)
+    except OSError as err:
+        raise SmiError("starting `nvidia-smi` failed: %s" % err)
+    watchdog = threading.Timer(SMI_TIMEOUT, kill_process_group, [proc])
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        stdout = proc.communicate()[0]
+    finally:
+        watchdog.cancel()
+        # on Python 2 a daemon thread still running at exit produces an error:
+        watchdog.join()
+    if proc.returncode == -signal.SIGKILL:
+        raise SmiError("`nvidia-smi` killed after %s seconds" % SMI_TIMEOUT)
+    if proc.returncode:
+        raise SmiError("`nvidia-smi` failed with exit code %s" % proc.returncode)
+    return stdout
+
+
+def poll_smi(names=None):
+    """Run `nvidia-smi` once and return the parsed CSV rows.
+
+    Parameters
+    ----------
+    names : list(str), optional
+        The properties to query for, by default the ones of the frequent queries.
+
+    Returns
+    -------
+    list(list(str))
+        The parsed CSV rows (header and empty lines removed), one row per GPU.
+
+    Raises
+    ------
+    SmiError
+        Raised in case the command timed out or failed.
+    """
+    if names is None:
+        names = FIELDS.query_names
+    with STATS.timed("smi"):
+        stdout = run_smi(smi_query(names))
+    with STATS.timed("parse"):
+        return parse_smi_output(stdout, names)
+
+
+def rows_collection(rows):
+    """Assemble a Prometheus metric collection from the processed values of all GPUs.
+
+    Parameters
+    ----------
+    rows : list(list)
+        The processed values, one row per GPU (ordered like `SCHEMA.names`).
+
+    Returns
+    -------
+    PromMetricCollection
+    """
+    with STATS.timed("process"):
+        collection = PromMetricCollection()
+        for row in rows:
+            SCHEMA.add_row(row, collection)
+        if PROCS is not None:
+            PROCS.update_labels(rows)
+        for monitor in MONITORS:
+            monitor.update_labels(rows)
+        if ENERGY is not None:
+            ENERGY.add(rows)
+            ENERGY.add_to(collection)
+        if THROTTLE is not None:
+            THROTTLE.add(rows)
+            THROTTLE.add_to(collection)
+    return collection
+
+
+def complete_metrics(collection):
+    """Add the process and `dmon` metrics and the exporter's own ones to a collection.
+
+    Parameters
+    ----------
+    collection : PromMetricCollection
+    """
+    if PROCS is not None:
+        PROCS.add_to(collection)
+    for monitor in MONITORS:
+        monitor.add_to(collection)
+    HEALTH.add_to(collection)
+    STATS.add_to(collection)
+
+
+def write_metrics(collection):
+    """Write a metric collection in Prometheus format to the textfile (or stdout).
+
+    Parameters
+    ----------
+    collection : PromMetricCollection
+        The collection to be written.
+    """
+    complete_metrics(collection)
+    try:
+        output_metrics(collection)
+    except (IOError, OSError) as err:
+        LOG.error("Writing metrics failed: %s", err)
+        STATS.count_error()
+
+
+def output_metrics(collection):
+    """Format a completed metric collection and write it to the textfile (or stdout).
+
+    Parameters
+    ----------
+    collection : PromMetricCollection
+    """
+    with STATS.timed("render"):
+        chunks = collection.chunks()
+    with STATS.timed("write"):
+        if WRITER is None:
+            print("".join(chunks))
+        else:
+            WRITER.write(chunks)
+            LOG.debug("Wrote metrics to [%s].", WRITER.filename)
+
+
+def start_writer():
+    """Start a thread rendering and writing the metrics, see `SnapshotBuffer`.
+
+    Returns
+    -------
+    callable
+        The function to call with each new `PromMetricCollection` (instead of
+        `write_metrics()`), it returns immediately.
+    """
+    buffer = SnapshotBuffer()
+
+    def write_snapshots():
+        while True:
+            collection = buffer.take()
+            try:
+                output_metrics(collection)
+            except Exception as err:  # pylint: disable-msg=broad-except
+                LOG.error("Writing metrics failed: %s", err)
+                STATS.count_error()
+            finally:
+                buffer.done()
+
+    def queue_metrics(collection):
+        buffer.add_to(collection)
+        complete_metrics(collection)
+        buffer.put(collection)
+
+    writer = threading.Thread(target=write_snapshots, name="writer")
+    writer.daemon = True
+    writer.start()
+    # don't lose the last snapshot when exiting (e.g. on KeyboardInterrupt):
+    atexit.register(buffer.drain, SMI_TIMEOUT)
+    return queue_metrics
+
+
+class Scheduler(object):
+
+    """Drift-free scheduler for periodic tasks based on monotonic deadlines.
+
+    The deadlines are computed from the start time and the interval, so the time spent
+    for the actual work does not add up over time (as it would by simply sleeping for
+    the interval after each run). If a run takes longer than the interval, the ticks
+    that have been missed are skipped (and counted) instead of being caught up on.
+
+    Attributes
+    ----------
+    interval : float
+        The interval between two ticks in seconds.
+    skipped : int
+        The total number of ticks that have been skipped.
+    """
+
+    def __init__(self, interval, align=False, splay=0.0, grace=None):
+        """Initialize the scheduler, the first tick is due immediately (or aligned).
+
+        Parameters
+        ----------
+        interval : float
+            See the class attributes for details.
+        align : bool, optional
+            Align the ticks to wall-clock multiples of the interval, by default False.
+        splay : float, optional
+            Maximum offset in seconds for the first tick, the actual value is derived
+            from the hostname so it's stable per host, by default 0.
+        grace : float, optional
+            Lateness in seconds that is tolerated before a tick is considered as
+            missed, e.g. the sampling period when the ticks are only checked via
+            `due()` whenever a sample arrives, by default 10% of the interval.
+        """
+        # pylint: disable-msg=import-outside-toplevel
+        import socket  # only needed here, not imported globally to speed up `--once`
+        import zlib
+
+        self.interval = interval
+        self.skipped = 0
+        hostname = socket.gethostname().encode("utf-8")
+        offset = (zlib.crc32(hostname) & 0xFFFFFFFF) % 1000 / 1000.0 * splay
+        if align:
+            offset = (offset - time.time()) % interval
+        self._next = monotonic() + offset
+        self._grace = interval * 0.1 if grace is None else grace
+
+    def _skip_missed(self, now):
+        """Advance the next deadline past all ticks that have been missed entirely."""
+        late = now - self._next
+        if late > self._grace + self.interval:
+            # only whole intervals count as missed, a late tick is still run:
+            missed = int((late - self._grace) // self.interval)
+            LOG.warning("Collection overran, skipping %s tick(s)", missed)
+            self.skipped += missed
+            self._next += missed * self.interval
+
+    def wait(self):
+        """Sleep until the next tick is due."""
+        now = monotonic()
+        self._skip_missed(now)
+        if now < self._next:
+            LOG.debug("Sleeping for %.3f seconds...", self._next - now)
+            time.sleep(self._next - now)
+        self._next += self.interval
+
+    def due(self):
+        """Check (without blocking) if the next tick is due, advancing it if so.
+
+        Returns
+        -------
+        bool
+        """
+        now = monotonic()
+        if now < self._next:
+            return False
+        self._skip_missed(now)
+        if now < self._next:
+            return False
+        self._next += self.interval
+        return True
+
+    def add_to(self, metric_collection):
+        """Add the number of skipped ticks to a metric collection.
+
+        Parameters
+        ----------
+        metric_collection : PromMetricCollection
+        """
+        name = "nvsmi_exporter_skipped_ticks_total"
+        metric_collection.add_line(
+            name,
+            "# HELP %s collection runs skipped due to overruns" % name,
+            "# TYPE %s counter" % name,
+            "%s %s" % (name, self.skipped),
+        )
+
+
+class MetricsCache(object):
+
+    """Cache for the formatted metrics, making sure only one collection runs at a time.
+
+    If the cached output is older than `ttl` seconds the next request triggers a new
+    collection run. Concurrent requests arriving meanwhile are waiting for that run to
+    finish and will all be answered with its result (single-flight), so e.g. multiple
+    Prometheus servers scraping at the same time never cause more than one call to
+    `nvidia-smi`.
+
+    Attributes
+    ----------
+    ttl : float
+        The number of seconds the cached output is considered fresh.
+    """
+
+    def __init__(self, collect, ttl):
+        """Initialize the cache.
+
+        Parameters
+        ----------
+        collect : callable or None
+            A function returning a new `PromMetricCollection`. If `None`, the cache
+            doesn't collect by itself but only serves what was passed to `store()`.
+        ttl : float
+            See the class attributes for details.
+        """
+        self._collect = collect
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cached = (None, 0)  # (output, timestamp) - replaced in a single step
+
+    def store(self, collection):
+        """Format a metric collection and store the result in the cache.
+
+        Parameters
+        ----------
+        collection : PromMetricCollection
+        """
+        complete_metrics(collection)
+        with STATS.timed("render"):
+            output = b"".join([utf8_bytes(x) for x in collection.chunks()])
+        self._cached = (output, monotonic())
+
+    def _fresh(self):
+        """Get the cached output if it's younger than `ttl`, `None` otherwise."""
+        output, timestamp = self._cached
+        if output is not None and monotonic() - timestamp < self.ttl:
+            return output
+        return None
+
+    def get(self):
+        """Get the formatted metrics, collecting them if the cache is outdated.
+
+        Returns
+        -------
+        bytes
+            The metrics in Prometheus format, encoded as UTF-8.
+        """
+        output = self._fresh()
+        if output is not None:
+            return output
+        with self._lock:
+            # another request might have refreshed the cache while we were waiting:
+            output = self._fresh()
+            if output is not None:
+                return output
+            if self._collect is None:
+                return self._cached[0] or b""
+            self.store(self._collect())
+            return self._cached[0]
+
+
+def metrics_server(address, cache):
+    """Create a threaded HTTP server answering requests from a `MetricsCache`.
+
+    The HTTP modules are only imported here, as they account for a considerable part
+    of the startup time and are not needed for writing textfiles.
+
+    Parameters
+    ----------
+    address : tuple
+        The `(host, port)` tuple to bind to.
+    cache : MetricsCache
+
+    Returns
+    -------
+    HTTPServer
+    """
+    # pylint: disable-msg=import-outside-toplevel
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:  # Python 2
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        """Request handler serving the metrics from the server's `MetricsCache`."""
+
+        def do_GET(self):  # pylint: disable-msg=invalid-name
+            """Answer a GET request, only `/metrics` is supported."""
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            try:
+                body = self.server.cache.get()
+            except Exception as err:  # pylint: disable-msg=broad-except
+                LOG.error("Collecting metrics failed: %s", err)
+                STATS.count_error()
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable-msg=redefined-builtin
+            """Send the access log to the debug log instead of stderr."""
+            LOG.debug("HTTP %s - %s", self.address_string(), format % args)
+
+    class MetricsServer(ThreadingMixIn, HTTPServer):
+
+        """Threaded HTTP server holding a `MetricsCache` for its request handlers."""
+
+        daemon_threads = True
+
+    server = MetricsServer(address, MetricsHandler)
+    server.cache = cache
+    return server
+
+
+def smi_stream(loop_ms):
+    """Create a stream for the frequent queries, see `SmiStream` for details."""
+    if PROBER is not None:
+        FIELDS.prune(PROBER.run())
+    return SmiStream(FIELDS.query_names, loop_ms, FIELDS.query_names.index("gpu_uuid"))
+
+
+def guarded_collection(collect):
+    """Run a collection, unless backing off, without ever raising an exception.
+
+    Parameters
+    ----------
+    collect : callable
+        A function returning a new `PromMetricCollection`.
+
+    Returns
+    -------
+    PromMetricCollection
+        The collected metrics or an empty collection in case the collection failed or
+        was skipped (the health metrics will be added in any case when writing).
+    """
+    if HEALTH.allow():
+        try:
+            collection = collect()
+            HEALTH.success()
+            return collection
+        except Exception as err:  # pylint: disable-msg=broad-except
+            LOG.error("Collecting metrics failed: %s", err)
+            STATS.count_error()
+            HEALTH.failure()
+    return PromMetricCollection()
+
+
+def follow_stream(stream, sink):
+    """Process each batch from a stream and pass the resulting metrics to a sink.
+
+    Parameters
+    ----------
+    stream : SmiStream
+    sink : callable
+        The function to call with the `PromMetricCollection` of each batch.
+    """
+    try:
+        for rows in stream.batches():
+            sink(guarded_collection(lambda: rows_collection(FIELDS.merge(rows))))
+    finally:
+        stream.stop()
+
+
+def high_rate_samples():
+    """Generator yielding the processed rows of all GPUs every SAMPLE_MS milliseconds.
+
+    For the `smi` backend a persistent `nvidia-smi --loop-ms` stream is used.
+
+    Yields
+    ------
+    list(list)
+        The processed values of all GPUs, one row per GPU.
+    """
+    if BACKEND == "nvml":
+        nvml = NvmlBackend()
+        atexit.register(nvml.shutdown)
+        ticks = Scheduler(SAMPLE_MS / 1000.0)
+        while True:
+            ticks.wait()
+            try:
+                with STATS.timed("nvml"):
+                    rows = nvml.collect()
+            except NvmlError as err:
+                LOG.error("Collecting metrics failed: %s", err)
+                STATS.count_error()
+                HEALTH.failure()
+                continue
+            HEALTH.success()
+            yield rows
+
+    stream = smi_stream(SAMPLE_MS)
+    try:
+        for rows in stream.batches():
+            try:
+                yield FIELDS.merge(rows)
+            except SmiError as err:
+                LOG.error("Querying static properties failed: %s", err)
+                STATS.count_error()
+                HEALTH.failure()
+    finally:
+        stream.stop()
+
+
+def run_aggregated(sink):
+    """Sample at a high rate and pass the aggregates to a sink every SLEEP_TIME seconds.
+
+    Parameters
+    ----------
+    sink : callable
+        The function to call with the aggregated `PromMetricCollection`.
+    """
+    aggregator = Aggregator(SCHEMA)
+    # the ticks are only checked when a sample arrives, so they can be late by up to
+    # one sampling period:
+    grace = max(SAMPLE_MS / 1000.0, SLEEP_TIME * 0.1)
+    ticks = Scheduler(SLEEP_TIME, ALIGN, SPLAY, grace)
+    ticks.due()  # skip the first tick, nothing has been sampled yet
+    for rows in high_rate_samples():
+        aggregator.add(rows)
+        if ENERGY is not None:
+            ENERGY.add(rows)
+        if THROTTLE is not None:
+            THROTTLE.add(rows)
+        if not ticks.due():
+            continue
+        if PROCS is not None:
+            PROCS.update_labels(rows)
+        for monitor in MONITORS:
+            monitor.update_labels(rows)
+        collection = PromMetricCollection()
+        aggregator.add_to(collection)
+        if ENERGY is not None:
+            ENERGY.add_to(collection)
+        if THROTTLE is not None:
+            THROTTLE.add_to(collection)
+        ticks.add_to(collection)
+        sink(collection)
+
+
+def polling_collector():
+    """Set up the configured backend for polling.
+
+    Returns
+    -------
+    callable
+        A function returning a new `PromMetricCollection` on each call.
+    """
+    if BACKEND == "nvml":
+        nvml = NvmlBackend()
+        atexit.register(nvml.shutdown)
+
+        def collect():
+            with STATS.timed("nvml"):
+                rows = nvml.collect()
+            return rows_collection(rows)
+
+        return collect
+
+    if PROBER is not None:
+        FIELDS.prune(PROBER.run())
+        FIELDS.probe = PROBER
+    LOG.info("call to `nvidia-smi`: <%s>", " ".join(smi_query(FIELDS.query_names)))
+    return lambda: rows_collection(FIELDS.merge(poll_smi()))
+
+
+def serve_http():
+    """Serve the metrics via HTTP until interrupted."""
+    if SAMPLE_MS or (LOOP_MS and BACKEND != "nvml"):
+        cache = MetricsCache(None, CACHE_TTL)
+        if SAMPLE_MS:
+            sampler = threading.Thread(target=run_aggregated, args=(cache.store,))
+        else:
+            stream = smi_stream(LOOP_MS)
+            sampler = threading.Thread(target=follow_stream, args=(stream, cache.store))
+        sampler.daemon = True
+        sampler.start()
+    else:
+        collect = polling_collector()
+        cache = MetricsCache(lambda: guarded_collection(collect), CACHE_TTL)
+
+    server = metrics_server((LISTEN_ADDRESS, LISTEN_PORT), cache)
+    LOG.info("Serving metrics on port %s at /metrics", LISTEN_PORT)
+    server.serve_forever()
+
+
+USAGE = """usage: %s [--once]
+
+%s
+
+The configuration is done through environment variables, see the README for details.
+
+optional arguments:
+  --once  collect and write the metrics a single time and exit (e.g. when run
+          through a systemd timer or cron), the exit code is 1 if collecting failed
+"""
+
+
+def main(argv=None):
+    """Run the collector in the mode selected by the configuration.
+
+    Parameters
+    ----------
+    argv : list(str), optional
+        The command line arguments, by default `sys.argv[1:]`.
+
+    Returns
+    -------
+    int
+        The exit code, only relevant for `--once` (all other modes run forever).
+    """
+    # `argparse` is not used as importing it takes longer than running `--once`:
+    if argv is None:
+        argv = sys.argv[1:]
+    if [x for x in argv if x != "--once"]:
+        sys.stderr.write(USAGE % (path.basename(sys.argv[0]), __doc__))
+        return 2
+
+    metrics = METRICS
+    if EXTRA_FIELDS:
+        metrics = METRICS + extra_metrics(EXTRA_FIELDS)
+    if "--once" in argv:
+        setup(metrics, once=True)
+        write_metrics(guarded_collection(polling_collector()))
+        return 1 if HEALTH.failures else 0
+
+    setup(metrics)
+    for monitor in MONITORS:
+        monitor.start()
+
+    if LISTEN_PORT:
+        serve_http()
+        return 0
+
+    sink = start_writer() if ASYNC_WRITE else write_metrics
+    if SAMPLE_MS:
+        run_aggregated(sink)
+    elif LOOP_MS and BACKEND != "nvml":
+        follow_stream(smi_stream(LOOP_MS), sink)
+    else:
+        collect = polling_collector()
+        ticks = Scheduler(SLEEP_TIME, ALIGN, SPLAY)
+        while True:
+            ticks.wait()
+            collection = guarded_collection(collect)
+            ticks.add_to(collection)
+            sink(collection)
+    return 0
 
-    if TEXTFILE_DIR:
-        output_filename = path.join(TEXTFILE_DIR, "nvsmi.prom")
-        with open(output_filename, "w") as outfile:
-            outfile.write(str(collection))
-        LOG.debug("Wrote metrics to [%s].", output_filename)
-    else:
-        print(collection)
 
-    LOG.debug("Sleeping for %s seconds...", SLEEP_TIME)
-    time.sleep(SLEEP_TIME)
+if __name__ == "__main__":
+    sys.exit(main())
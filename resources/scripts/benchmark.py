@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""Benchmark the processing stages of the collector using synthetic `nvidia-smi` data.
+
+The phases are timed separately for each requested number of GPUs:
+
+* `parse` - parsing the raw CSV output of `nvidia-smi --format=csv,nounits` (mapping
+  the columns by the header) into processed value rows
+* `build` - assembling the `PromMetricCollection` from the value rows
+* `render` - formatting the collection via `PromMetricCollection.__str__()`
+
+For comparison, the `parse` phase is also run splitting the lines through the `csv`
+module instead of the specialized splitting in `parse_smi_output()` (`parse-csv`).
+
+For each phase the throughput (ops/s, one op being one complete cycle for all GPUs),
+the time per op and (on Python 3) the number of allocated memory blocks and the peak
+traced memory of a single op are reported. The peak RSS of the benchmark process is
+printed at the end. Example:
+
+$ python resources/scripts/benchmark.py --gpus 1,8,64,1024
+"""
+
+# pylint: disable-msg=invalid-name
+
+from __future__ import print_function
+
+import argparse
+import csv
+import resource
+from timeit import default_timer
+
+from nvsmi_synth import generate_csv, load_metrics
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+load_metrics()
+import nvidia_prometheus as nvp  # pylint: disable-msg=wrong-import-position
+
+
+def phase_parse(stdout):
+    """Parse the raw output into processed value rows."""
+    rows = nvp.parse_smi_output(stdout, nvp.SCHEMA.names)
+    return [nvp.SCHEMA.parse_row(x) for x in rows]
+
+
+def phase_parse_csv(stdout):
+    """Parse the raw output using the `csv` module for splitting the lines."""
+    lines = stdout.split("\n")
+    lines.pop(0)
+    rows = [x for x in csv.reader(lines, delimiter=",", skipinitialspace=True) if x]
+    return [nvp.SCHEMA.parse_row(x) for x in rows]
+
+
+def phase_build(rows):
+    """Assemble a metric collection from processed value rows."""
+    collection = nvp.PromMetricCollection()
+    for row in rows:
+        nvp.SCHEMA.add_row(row, collection)
+    return collection
+
+
+def phase_render(collection):
+    """Format a metric collection."""
+    return str(collection)
+
+
+def time_phase(func, arg, min_time):
+    """Run a phase repeatedly (at least 3 times and `min_time` seconds).
+
+    Returns
+    -------
+    (float, object)
+        The average time per run in seconds and the result of the last run.
+    """
+    runs = 0
+    start = default_timer()
+    elapsed = 0.0
+    while runs < 3 or elapsed < min_time:
+        result = func(arg)
+        runs += 1
+        elapsed = default_timer() - start
+    return elapsed / runs, result
+
+
+def trace_allocations(func, arg):
+    """Count the memory blocks allocated by a single run of a phase.
+
+    Returns
+    -------
+    (int, int) or (None, None)
+        The number of allocated blocks still alive after the run and the peak traced
+        memory in bytes, `None` if `tracemalloc` is unavailable.
+    """
+    if tracemalloc is None:
+        return None, None
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = func(arg)  # pylint: disable-msg=unused-variable
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    blocks = sum(x.count_diff for x in after.compare_to(before, "filename"))
+    return blocks, peak
+
+
+def format_optional(value, scale=1):
+    """Format an optional integer value for the result table."""
+    if value is None:
+        return "n/a"
+    return "%d" % (value / scale)
+
+
+def run_phase(gpu_count, name, func, arg, min_time):
+    """Benchmark a single phase and print the results.
+
+    Returns
+    -------
+    object
+        The result of the phase.
+    """
+    per_op, result = time_phase(func, arg, min_time)
+    blocks, peak = trace_allocations(func, arg)
+    print(
+        "%6d  %-9s %12.1f %10.3f %12s %14s"
+        % (
+            gpu_count,
+            name,
+            1.0 / per_op,
+            per_op * 1000.0,
+            format_optional(blocks),
+            format_optional(peak, 1024),
+        )
+    )
+    return result
+
+
+def run(gpu_counts, min_time):
+    """Run the benchmark for all given GPU counts and print the results."""
+    print(
+        "%6s  %-9s %12s %10s %12s %14s"
+        % ("gpus", "phase", "ops/s", "ms/op", "alloc blocks", "alloc peak KiB")
+    )
+    for gpu_count in gpu_counts:
+        arg = generate_csv(gpu_count, nvp.METRICS, units=False)
+        run_phase(gpu_count, "parse-csv", phase_parse_csv, arg, min_time)
+        for name, func in (
+            ("parse", phase_parse),
+            ("build", phase_build),
+            ("render", phase_render),
+        ):
+            # the result of each phase is the input of the next one:
+            arg = run_phase(gpu_count, name, func, arg, min_time)
+
+    # `ru_maxrss` is reported in kilobytes on Linux:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("\npeak RSS: %.1f MiB" % (peak_rss / 1024.0))
+
+
+def parse_arguments():
+    """Parse the command line arguments."""
+    argparser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    argparser.add_argument(
+        "--gpus",
+        default="1,8,64,256,1024",
+        help="comma separated list of GPU counts to benchmark (default: %(default)s)",
+    )
+    argparser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.5,
+        help="minimum number of seconds to run each phase (default: %(default)s)",
+    )
+    return argparser.parse_args()
+
+
+if __name__ == "__main__":
+    ARGS = parse_arguments()
+    run([int(x) for x in ARGS.gpus.split(",")], ARGS.min_time)
@@ -0,0 +1,200 @@
+/*
+ * Fake NVML library for testing the `nvml` backend on machines without a GPU.
+ *
+ * Implements only the `nvml*` functions used by `NvmlBackend`, reporting the same
+ * four Tesla M10 GPUs as the `nvidia-smi` mocking script in this directory. The fan
+ * speed is reported as not supported, like on the passively cooled real boards.
+ * Build it as a shared library and point NVML_LIBRARY to it:
+ *
+ * $ cc -shared -fPIC -o /tmp/libnvidia-ml.so resources/scripts/fake_nvml.c
+ * $ BACKEND=nvml NVML_LIBRARY=/tmp/libnvidia-ml.so python nvidia_prometheus.py --once
+ */
+
+#include <stdio.h>
+#include <string.h>
+
+#define NVML_SUCCESS 0
+#define NVML_ERROR_INVALID_ARGUMENT 2
+#define NVML_ERROR_NOT_SUPPORTED 3
+
+typedef struct {
+    const char *uuid;
+    unsigned int utilization_gpu;
+    unsigned int utilization_memory;
+    unsigned int temperature;
+    unsigned int power_milliwatts;
+    unsigned int pci_bus;
+    unsigned int link_gen;
+    unsigned long long throttle_reasons;
+} fake_device;
+
+typedef struct {
+    unsigned int gpu;
+    unsigned int memory;
+} nvmlUtilization_t;
+
+typedef struct {
+    unsigned long long total;
+    unsigned long long free;
+    unsigned long long used;
+} nvmlMemory_t;
+
+typedef struct {
+    char busIdLegacy[16];
+    unsigned int domain;
+    unsigned int bus;
+    unsigned int device;
+    unsigned int pciDeviceId;
+    unsigned int pciSubSystemId;
+    char busId[32];
+} nvmlPciInfo_t;
+
+static fake_device devices[] = {
+    {"GPU-60c-73-d2-85-67bb", 0, 0, 36, 10580, 0x83, 1, 0x1},
+    {"GPU-0e6-a4-67-1a-b784", 0, 0, 38, 10780, 0x84, 1, 0x1},
+    {"GPU-c5b-d9-3b-f5-cb44", 18, 4, 32, 10680, 0x85, 1, 0x0},
+    {"GPU-6af-fd-84-ac-6d92", 21, 7, 42, 24750, 0x86, 3, 0x24},
+};
+
+#define DEVICE_COUNT (sizeof(devices) / sizeof(devices[0]))
+
+static int copy_string(const char *value, char *buf, unsigned int length)
+{
+    if (strlen(value) >= length)
+        return NVML_ERROR_INVALID_ARGUMENT;
+    strcpy(buf, value);
+    return NVML_SUCCESS;
+}
+
+int nvmlInit_v2(void) { return NVML_SUCCESS; }
+
+int nvmlShutdown(void) { return NVML_SUCCESS; }
+
+int nvmlSystemGetDriverVersion(char *buf, unsigned int length)
+{
+    return copy_string("430.67", buf, length);
+}
+
+int nvmlDeviceGetCount_v2(unsigned int *count)
+{
+    *count = DEVICE_COUNT;
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetHandleByIndex_v2(unsigned int index, fake_device **device)
+{
+    if (index >= DEVICE_COUNT)
+        return NVML_ERROR_INVALID_ARGUMENT;
+    *device = &devices[index];
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetIndex(fake_device *device, unsigned int *index)
+{
+    *index = (unsigned int)(device - devices);
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetSerial(fake_device *device, char *buf, unsigned int length)
+{
+    (void)device;
+    return copy_string("1234567891234", buf, length);
+}
+
+int nvmlDeviceGetUUID(fake_device *device, char *buf, unsigned int length)
+{
+    return copy_string(device->uuid, buf, length);
+}
+
+int nvmlDeviceGetName(fake_device *device, char *buf, unsigned int length)
+{
+    (void)device;
+    return copy_string("Tesla M10", buf, length);
+}
+
+int nvmlDeviceGetUtilizationRates(fake_device *device, nvmlUtilization_t *util)
+{
+    util->gpu = device->utilization_gpu;
+    util->memory = device->utilization_memory;
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetMemoryInfo(fake_device *device, nvmlMemory_t *memory)
+{
+    (void)device;
+    memory->total = 8191ULL << 20;
+    memory->free = 49ULL << 20;
+    memory->used = 8142ULL << 20;
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetTemperature(fake_device *device, int sensor, unsigned int *temp)
+{
+    (void)sensor;
+    *temp = device->temperature;
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetFanSpeed(fake_device *device, unsigned int *speed)
+{
+    (void)device;
+    (void)speed;
+    return NVML_ERROR_NOT_SUPPORTED;
+}
+
+int nvmlDeviceGetPowerUsage(fake_device *device, unsigned int *milliwatts)
+{
+    *milliwatts = device->power_milliwatts;
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetPowerManagementLimit(fake_device *device, unsigned int *milliwatts)
+{
+    (void)device;
+    *milliwatts = 53000;
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetPciInfo_v3(fake_device *device, nvmlPciInfo_t *pci)
+{
+    memset(pci, 0, sizeof(*pci));
+    pci->bus = device->pci_bus;
+    pci->pciDeviceId = 0xC0FFEEEE;
+    snprintf(pci->busId, sizeof(pci->busId), "00000000:%02X:00.0", pci->bus);
+    snprintf(pci->busIdLegacy, sizeof(pci->busIdLegacy), "0000:%02X:00.0", pci->bus);
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetCurrentClocksThrottleReasons(
+    fake_device *device, unsigned long long *reasons)
+{
+    *reasons = device->throttle_reasons;
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetCurrPcieLinkGeneration(fake_device *device, unsigned int *gen)
+{
+    *gen = device->link_gen;
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetMaxPcieLinkGeneration(fake_device *device, unsigned int *gen)
+{
+    (void)device;
+    *gen = 3;
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetCurrPcieLinkWidth(fake_device *device, unsigned int *width)
+{
+    (void)device;
+    *width = 8;
+    return NVML_SUCCESS;
+}
+
+int nvmlDeviceGetMaxPcieLinkWidth(fake_device *device, unsigned int *width)
+{
+    (void)device;
+    *width = 16;
+    return NVML_SUCCESS;
+}
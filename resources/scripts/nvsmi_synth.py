@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""Generator for synthetic `nvidia-smi --query-gpu` CSV output for any number of GPUs.
+
+The output follows the format produced by `nvidia-smi --format=csv`, including the
+unit suffixes (e.g. `8191 MiB`, `10.58 W`) in the values and the header, and randomly
+scattered `[Not Supported]` cells. Optionally the unit suffixes can be omitted from the
+values, like `nvidia-smi --format=csv,nounits` does. When called directly it prints the
+CSV for the number of GPUs given as the first argument (default 4) to stdout:
+
+$ python resources/scripts/nvsmi_synth.py 1024 > /tmp/nvsmi-1024.csv
+"""
+
+# pylint: disable-msg=invalid-name
+
+from __future__ import print_function
+
+import random
+import sys
+
+GPU_NAMES = ["Tesla M10", "Tesla V100-SXM2-32GB", "NVIDIA A100-SXM4-80GB"]
+
+# properties that are reported as "[Not Supported]" on all (passively cooled) boards:
+ALWAYS_NOT_SUPPORTED = ["fan.speed"]
+
+# probability for any other numeric cell to be reported as "[Not Supported]":
+NOT_SUPPORTED_RATIO = 0.02
+
+# the unit strings appended by `nvidia-smi`, using the metric's name suffix as the key:
+UNITS = {"_ratio": "%", "_bytes": "MiB", "_watts": "W"}
+
+
+def header_line(metrics):
+    """Assemble the CSV header line `nvidia-smi` would print for the given metrics.
+
+    Parameters
+    ----------
+    metrics : list(NvMetric)
+        The metric definitions to generate the header for.
+
+    Returns
+    -------
+    str
+    """
+    names = list()
+    for metric in metrics:
+        unit = UNITS.get(metric.name_suffix)
+        if unit:
+            names.append("%s [%s]" % (metric.name, unit))
+        else:
+            names.append(metric.name)
+    return ", ".join(names)
+
+
+def fake_value(metric, index, rng, units=True):
+    """Generate a realistic looking raw value for a single metric.
+
+    Parameters
+    ----------
+    metric : NvMetric
+        The metric definition to generate a value for.
+    index : int
+        The GPU's index.
+    rng : random.Random
+        The random number generator to use.
+    units : bool, optional
+        Whether to append the unit string to the value, by default True.
+
+    Returns
+    -------
+    str
+    """
+    name = metric.name
+    if name in ALWAYS_NOT_SUPPORTED:
+        return "[Not Supported]"
+    if name == "index":
+        return str(index)
+    if name == "driver_version":
+        return "430.67"
+    if name == "gpu_serial":
+        return "%013d" % (1234567890000 + index)
+    if name == "gpu_uuid":
+        return "GPU-%08x-%04x-%04x-%04x-%012x" % (
+            rng.getrandbits(32),
+            rng.getrandbits(16),
+            rng.getrandbits(16),
+            rng.getrandbits(16),
+            rng.getrandbits(48),
+        )
+    if name == "gpu_name":
+        return GPU_NAMES[index % len(GPU_NAMES)]
+    if name == "pci.domain":
+        return "0x%04X" % (index // 256)
+    if name == "pci.bus":
+        return "0x%02X" % (index % 256)
+    if name == "pci.device":
+        return "0x00"
+    if name == "pci.device_id":
+        return "0x13BD10DE"
+    if metric.value_type == "str":
+        return "n/a"
+    if metric.value_type == "bitmask":
+        return "0x%016X" % rng.choice([0x0, 0x1, 0x4, 0x24])
+
+    if rng.random() < NOT_SUPPORTED_RATIO:
+        return "[Not Supported]"
+    unit = UNITS.get(metric.name_suffix)
+    if unit == "%":
+        value = "%d" % rng.randint(0, 100)
+    elif unit == "MiB":
+        value = "%d" % rng.randint(0, 81920)
+    elif unit == "W":
+        value = "%.2f" % rng.uniform(10.0, 400.0)
+    else:
+        return str(rng.randint(1, 90))
+    if units:
+        return "%s %s" % (value, unit)
+    return value
+
+
+def generate_csv(gpu_count, metrics, seed=0, units=True):
+    """Generate the complete `nvidia-smi --format=csv` output for a number of GPUs.
+
+    Parameters
+    ----------
+    gpu_count : int
+        The number of GPUs (rows) to generate.
+    metrics : list(NvMetric)
+        The metric definitions (columns) to generate.
+    seed : int, optional
+        The seed for the random number generator, by default 0.
+    units : bool, optional
+        Whether to include the unit strings in the values, by default True.
+
+    Returns
+    -------
+    str
+    """
+    rng = random.Random(seed)
+    lines = [header_line(metrics)]
+    for index in range(gpu_count):
+        lines.append(", ".join([fake_value(x, index, rng, units) for x in metrics]))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def load_metrics():
+    """Import the metric definitions from the collector script in the repo root."""
+    sys.path.insert(0, sys.path[0] + "/../..")
+    import nvidia_prometheus  # pylint: disable-msg=import-outside-toplevel
+
+    return nvidia_prometheus.METRICS
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    sys.stdout.write(generate_csv(count, load_metrics()))